@@ -211,9 +211,15 @@ def onetimeclientsetup(ui):
 
     # close cache miss server connection after the command has finished
     def runcommand(orig, lui, repo, *args, **kwargs):
+        accesslog = repo.fileservice.accesslog
+        if accesslog:
+            # args[0] is the command name
+            accesslog.start(args[0])
         try:
             return orig(lui, repo, *args, **kwargs)
         finally:
+            if accesslog:
+                accesslog.finish()
             repo.fileservice.close()
     wrapfunction(dispatch, 'runcommand', runcommand)
 
@@ -326,24 +332,66 @@ def onetimeclientsetup(ui):
 def getrenamedfn(repo, endrev=None):
     rcache = {}
 
+    def cacherenames(fn, rev):
+        """reads the histories of fn and of the other files of changeset rev
+        in one batch, and records the renames of each of their ancestors"""
+        ctx = repo[rev]
+        clrev = remotefilelog.linkrevfn(repo)
+        renameindex = repo.fileservice.renameindex
+        fileids = []
+        for f in set(ctx.files()) | set([fn]):
+            if rev in rcache.setdefault(f, {}) or f not in ctx:
+                continue
+            if not repo.shallowmatch(f):
+                rcache[f][rev] = ctx[f].renamed()
+                continue
+
+            filenode = ctx.filenode(f)
+            if renameindex.get(f, filenode) is False:
+                # known not to be a copy
+                rcache[f][rev] = None
+            else:
+                fileids.append((f, filenode))
+
+        try:
+            maps = remotefilelog.ancestormaps(repo, fileids,
+                                              relativeto=ctx.node())
+        except error.LookupError:
+            # Load the files one at a time, so one missing history only
+            # loses the renames of that file.
+            maps = {}
+            for f, filenode in fileids:
+                try:
+                    maps[(f, filenode)] = repo.file(f).ancestormap(filenode,
+                        relativeto=ctx.node())
+                except error.LookupError:
+                    rcache[f][rev] = None
+
+        for (f, filenode), ancestormap in maps.iteritems():
+            renames = rcache[f]
+            for path, node, linkrev in remotefilectx.ancestorrecords(
+                    ancestormap, f, filenode, clrev):
+                if path == f:
+                    p1, p2, linknode, copyfrom = ancestormap[node]
+                    renames[linkrev] = (copyfrom, p1) if copyfrom else None
+
+            fctx = remotefilectx.remotefilectx(repo, f, changeid=rev,
+                                               fileid=filenode,
+                                               ancestormap=ancestormap)
+            renames[rev] = fctx.renamed()
+
     def getrenamed(fn, rev):
         '''looks up all renames for a file (up to endrev) the first
         time the file is given. It indexes on the changerev and only
         parses the manifest if linkrev != changerev.
+        The files of a changeset are looked up together, so their
+        histories are fetched in one batch.
         Returns rename info for fn at changerev rev.'''
         if rev in rcache.setdefault(fn, {}):
             return rcache[fn][rev]
 
-        try:
-            fctx = repo[rev].filectx(fn)
-            for ancestor in fctx.ancestors():
-                if ancestor.path() == fn:
-                    renamed = ancestor.renamed()
-                    rcache[fn][ancestor.rev()] = renamed
-
-            return fctx.renamed()
-        except error.LookupError:
-            return None
+        cacherenames(fn, rev)
+        return rcache[fn].get(rev)
 
     return getrenamed
 
@@ -351,14 +399,25 @@ def walkfilerevs(orig, repo, match, follow, revs, fncache):
     if not shallowrepo.requirement in repo.requirements:
         return orig(repo, match, follow, revs, fncache)
 
-    # remotefilelog's can't be walked in rev order, so throw.
-    # The caller will see the exception and walk the commit tree instead.
-    if not follow:
-        raise cmdutil.FileWalkError("Cannot walk via filelog")
-
     wanted = set()
     minrev, maxrev = min(revs), max(revs)
 
+    # remotefilelog's can't be walked in rev order, so use the path index, or
+    # throw. The caller will see the exception and walk the commit tree
+    # instead.
+    if not follow:
+        index = repo.pathindex
+        for filename in match.files():
+            filerevs = index.revs(filename) if index else None
+            if not filerevs:
+                # not indexed, or possibly a directory
+                raise cmdutil.FileWalkError("Cannot walk via filelog")
+            for rev in filerevs:
+                if rev >= minrev and rev <= maxrev:
+                    fncache.setdefault(rev, []).append(filename)
+                    wanted.add(rev)
+        return wanted
+
     pctx = repo['.']
     for filename in match.files():
         if filename not in pctx:
@@ -371,10 +430,9 @@ def walkfilerevs(orig, repo, match, follow, revs, fncache):
             fncache.setdefault(linkrev, []).append(filename)
             wanted.add(linkrev)
 
-        for ancestor in fctx.ancestors():
-            linkrev = ancestor.linkrev()
+        for path, node, linkrev in fctx.ancestorrecords():
             if linkrev >= minrev and linkrev <= maxrev:
-                fncache.setdefault(linkrev, []).append(ancestor.path())
+                fncache.setdefault(linkrev, []).append(path)
                 wanted.add(linkrev)
 
     return wanted
@@ -397,7 +455,20 @@ def filelogrevset(orig, repo, subset, x):
                        ctx=repo[None])
     s = set()
 
-    if not match.patkind(pat):
+    index = repo.pathindex
+    indexed = None
+    if not match.patkind(pat) and index:
+        indexed = set()
+        for f in m.files():
+            filerevs = index.revs(f)
+            if filerevs is None:
+                indexed = None
+                break
+            indexed.update(filerevs)
+
+    if indexed is not None:
+        s = indexed
+    elif not match.patkind(pat):
         # slow
         for r in subset:
             ctx = repo[r]
@@ -408,13 +479,24 @@ def filelogrevset(orig, repo, subset, x):
                     break
     else:
         # partial
-        for f in repo[None]:
-            filenode = m(f)
-            if filenode:
-                fctx = repo.filectx(f, fileid=filenode)
-                s.add(fctx.linkrev())
-                for actx in fctx.ancestors():
-                    s.add(actx.linkrev())
+        mf = repo['.'].manifest()
+        fileids = []
+        for f, fnode in mf.iteritems():
+            if not m(f):
+                continue
+            if repo.shallowmatch(f):
+                fileids.append((f, fnode))
+            else:
+                # kept as a normal filelog
+                fl = repo.file(f)
+                for rev in fl.ancestors([fl.rev(fnode)], inclusive=True):
+                    s.add(fl.linkrev(rev))
+
+        clrev = remotefilelog.linkrevfn(repo)
+        maps = remotefilelog.ancestormaps(repo, fileids)
+        for ancestormap in maps.itervalues():
+            for p1, p2, linknode, copyfrom in ancestormap.itervalues():
+                s.add(clrev(linknode))
 
     return [r for r in subset if r in s]
 
@@ -513,8 +595,6 @@ def gcclient(ui, cachepath):
 
 def log(orig, ui, repo, *pats, **opts):
     if pats and not opts.get("follow"):
-        # Force slowpath for non-follow patterns
-        opts['removed'] = True
         match, pats = scmutil.matchandpats(repo['.'], pats, opts)
         isfile = not match.anypats()
         if isfile:
@@ -523,9 +603,16 @@ def log(orig, ui, repo, *pats, **opts):
                     isfile = False
                     break
 
-        if isfile:
-            ui.warn(_("warning: file log can be slow on large repos - " +
-                      "use -f to speed it up\n"))
+        # The path index makes file logs fast, via filelog() and
+        # walkfilerevs.
+        indexed = (isfile and shallowrepo.requirement in repo.requirements
+                   and repo.pathindex and repo.pathindex.update())
+        if not indexed:
+            # Force slowpath for non-follow patterns
+            opts['removed'] = True
+            if isfile:
+                ui.warn(_("warning: file log can be slow on large repos - " +
+                          "use -f to speed it up\n"))
 
     return orig(ui, repo, *pats, **opts)
 
@@ -533,13 +620,17 @@ def pull(orig, ui, repo, *pats, **opts):
     result = orig(ui, repo, *pats, **opts)
 
     if shallowrepo.requirement in repo.requirements:
+        if repo.pathindex:
+            repo.pathindex.update()
+
         # prefetch if it's configured
         prefetchrevset = ui.config('remotefilelog', 'pullprefetch', None)
         if prefetchrevset:
             ui.status("prefetching file contents\n")
             revs = repo.revs(prefetchrevset)
             base = repo['.'].rev()
-            repo.prefetch(revs, base=base)
+            background = ui.configbool('remotefilelog', 'backgroundprefetch')
+            repo.prefetch(revs, base=base, background=background)
 
     return result
 
@@ -620,6 +711,7 @@ def verifyremotefilelog(ui, *args, **opts):
 
 @command('^prefetch', [
     ('r', 'rev', [], _('prefetch the specified revisions'), _('REV')),
+    ('', 'background', None, _('fetch in a detached, low priority process')),
     ] + commands.walkopts, _('hg prefetch [OPTIONS] [FILE...]'))
 def prefetch(ui, repo, *pats, **opts):
     """prefetch file revisions from the server
@@ -629,6 +721,12 @@ def prefetch(ui, repo, *pats, **opts):
     commit. File names or patterns can be used to limit which files are
     downloaded.
 
+    Prefetching happens in chunks, and an interrupted prefetch resumes
+    where it stopped the next time :hg:`prefetch` runs. With --background,
+    the files are fetched by a detached, low priority process and the
+    command returns immediately. Prefetches that start while another one is
+    running are handed to it instead of fetching the same files twice.
+
     Return 0 on success.
     """
     if not shallowrepo.requirement in repo.requirements:
@@ -640,4 +738,5 @@ def prefetch(ui, repo, *pats, **opts):
     m = scmutil.matchall(repo)
     revs = scmutil.revrange(repo, opts.get('rev'))
 
-    repo.prefetch(revs, pats=pats, opts=opts)
+    repo.prefetch(revs, pats=pats, opts=opts,
+                  background=opts.get('background'))
@@ -0,0 +1,175 @@
+# accesslog.py - learns which file revisions commands read, to prefetch them
+#
+# Copyright 2016 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+from mercurial.node import bin, hex, nullid
+from mercurial import error, util
+import os
+
+# Where the per command statistics are kept, inside .hg
+logfile = 'remotefilelog.accesslog'
+
+# How much the previous statistics weigh against the latest command
+decay = 0.5
+
+class accesslog(object):
+    """Records the on demand fetches each kind of command makes, and uses
+    that history to predict and batch the fetches of the next similar
+    command.
+
+    Two patterns are learned, per command name:
+
+    - history walks, where a command misses on several revisions of the same
+      file (annotate, log -p). On the first miss of a file, its ancestors are
+      prefetched in one batch, as deep as such commands usually go.
+    - directory walks, where a command misses on several files of the same
+      directory (grep, diff of a subtree). On the first miss in a directory,
+      the other files of that directory in the same commit are prefetched.
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.command = None
+        self.maxdepth = repo.ui.configint('remotefilelog',
+                                          'predictiveprefetchdepth', 1000)
+        self._stats = None
+        self._reset()
+
+    def _reset(self):
+        self.misses = 0
+        self.historymisses = 0
+        self.dirmisses = 0
+        self._paths = set()
+        self._dirs = set()
+        self._predicted = set()
+
+    def _load(self):
+        if self._stats is None:
+            self._stats = {}
+            try:
+                data = self.repo.vfs.read(logfile)
+            except IOError:
+                data = ''
+            for line in data.splitlines():
+                try:
+                    command, misses, historymisses, dirmisses, paths = \
+                        line.split(' ')
+                    self._stats[command] = (float(misses),
+                                            float(historymisses),
+                                            float(dirmisses), float(paths))
+                except ValueError:
+                    continue
+        return self._stats
+
+    def start(self, command):
+        self.command = command
+        self._reset()
+
+    def finish(self):
+        """Folds the accesses of the finished command into the history."""
+        if self.command and self.misses:
+            stats = self._load()
+            old = stats.get(self.command, (0, 0, 0, 0))
+            new = (self.misses, self.historymisses, self.dirmisses,
+                   len(self._paths))
+            stats[self.command] = tuple(o * decay + n
+                                        for o, n in zip(old, new))
+
+            lines = ['%s %f %f %f %f\n' % ((command,) + values)
+                     for command, values in sorted(stats.iteritems())]
+            try:
+                f = self.repo.vfs(logfile, 'w', atomictemp=True)
+                try:
+                    f.write(''.join(lines))
+                finally:
+                    f.close()
+            except (IOError, OSError):
+                pass
+
+        self.command = None
+        self._reset()
+
+    def miss(self, path, id):
+        """Records an on demand fetch of path at hex node id, then prefetches
+        whatever similar commands went on to read."""
+        self.misses += 1
+        directory = os.path.dirname(path)
+        if path in self._paths:
+            self.historymisses += 1
+        elif directory in self._dirs:
+            self.dirmisses += 1
+        self._paths.add(path)
+        self._dirs.add(directory)
+
+        stats = self._load().get(self.command)
+        if not stats:
+            return
+        misses, historymisses, dirmisses, paths = stats
+
+        # Predictions are only a guess, so failing to fetch them must not
+        # fail the read that triggered them.
+        try:
+            fetch = []
+            if (historymisses * 2 > misses and path not in self._predicted):
+                self._predicted.add(path)
+                depth = min(int(historymisses / max(paths, 1)) + 1,
+                            self.maxdepth)
+                fetch.extend(self._ancestors(path, bin(id), depth))
+            if (dirmisses * 2 > misses and directory not in self._predicted):
+                self._predicted.add(directory)
+                fetch.extend(self._siblings(path, bin(id), directory))
+
+            if fetch:
+                self.repo.fileservice.prefetch(fetch)
+        except (error.LookupError, error.RepoError, util.Abort) as inst:
+            self.repo.ui.debug("predictive prefetch failed: %s\n" % inst)
+
+    def _localonly(self, linknode):
+        """Returns whether the file versions introduced by the given
+        changeset may exist only in this repo, because it is a draft. Unknown
+        changesets came from the server."""
+        repo = self.repo
+        rev = repo.unfiltered().changelog.nodemap.get(linknode)
+        return rev is not None and rev in repo._localrevs()
+
+    def _ancestors(self, path, node, depth):
+        """Returns up to depth (path, hexnode) ancestors of the given file
+        revision, closest first. Local-only revisions are walked through but
+        not returned."""
+        ancestormap = self.repo.file(path).ancestormap(node)
+        results = []
+        queue = [(path, node)]
+        seen = set(queue)
+        while queue and len(results) < depth:
+            current = []
+            for path, node in queue:
+                p1, p2, linknode, copyfrom = ancestormap[node]
+                for parent in ((copyfrom or path, p1), (path, p2)):
+                    if parent[1] != nullid and parent not in seen:
+                        seen.add(parent)
+                        current.append(parent)
+                        if not self._localonly(ancestormap[parent[1]][2]):
+                            results.append((parent[0], hex(parent[1])))
+            queue = current
+        return results[:depth]
+
+    def _siblings(self, path, node, directory):
+        """Returns the (path, hexnode) of the other files of directory in the
+        commit that introduced the given file revision. Nothing is returned
+        if that commit is a draft, since its files may not be on the server.
+        """
+        repo = self.repo
+        ancestormap = repo.file(path).ancestormap(node)
+        linknode = ancestormap[node][2]
+        if linknode not in repo or self._localonly(linknode):
+            return []
+
+        prefix = directory + '/' if directory else ''
+        results = []
+        for f, fnode in repo[linknode].manifest().iteritems():
+            if (f != path and f.startswith(prefix) and
+                os.path.dirname(f) == directory):
+                results.append((f, hex(fnode)))
+        return results
@@ -0,0 +1,260 @@
+# fetchscheduler.py - coordinates fetches between processes sharing a cache
+#
+# Copyright 2016 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+from mercurial import util
+import shallowutil
+import errno, os, socket, time
+
+# Fetches with a lower number go first.
+PRIORITY_DEMAND = 0
+PRIORITY_BULK = 1
+
+# directory inside the cachepath holding one ticket per running fetch
+ticketdir = '.fetches'
+
+# suffix of the lease file placed next to a cache key while it is fetched
+leasesuffix = '.lease'
+
+_counter = 0
+
+class fetchscheduler(object):
+    """Schedules the fetches of all the processes using the same cachepath.
+
+    Each running fetch is described by a ticket file in <cachepath>/.fetches,
+    named after its priority and owner. The owner touches its ticket while it
+    works, so a ticket that hasn't been touched for a while belongs to a
+    process that died, even on another host.
+
+    Before downloading a key, a fetch takes a lease on it by atomically
+    creating <key>.lease in the cache, containing its ticket name. A key
+    whose lease is held by a live ticket is already being downloaded, so it
+    is waited for instead of being downloaded twice, unless the holder has a
+    lower priority: a bulk fetch leases a whole chunk up front and may not
+    reach the key for a long time, so an on demand fetch downloads it
+    itself. Bulk fetches also pause while an on demand fetch is running.
+    """
+    def __init__(self, ui, cachepath):
+        self.ui = ui
+        self.cachepath = cachepath
+        self.path = os.path.join(cachepath, ticketdir)
+        self.hostname = socket.gethostname()
+        self.uid = os.getuid()
+        self.timeout = ui.configint('remotefilelog', 'fetchtimeout', 60)
+        self.priority = None
+        self._ticket = None
+        self._renewed = 0
+        self._leases = []
+        self._inflight = {}
+
+    def _tickets(self):
+        """yields (name, priority) for every live ticket but our own"""
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+
+        for name in names:
+            if name == self._ticket or name.startswith('.'):
+                continue
+            priority = self._alive(name)
+            if priority is not None:
+                yield name, priority
+
+    def _alive(self, name):
+        """Returns the priority of the named ticket if its owner is still
+        running, otherwise None."""
+        try:
+            priority, owner = name.split('_', 1)
+            hostname, pid, counter = owner.rsplit('_', 2)
+            priority = int(priority)
+            pid = int(pid)
+        except ValueError:
+            return None
+
+        # end() removes the ticket, so an owner without one has finished,
+        # even if its process lives on
+        path = os.path.join(self.path, name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+
+        if hostname == self.hostname:
+            if not util.testpid(pid):
+                shallowutil.unlinkifexists(path)
+                return None
+        elif time.time() - mtime >= self.timeout:
+            # We can't check pids on other hosts, so rely on the owner
+            # touching its ticket. It may only be slow, so leave the ticket
+            # for it to renew.
+            return None
+        return priority
+
+    def _leasepath(self, key):
+        return os.path.join(self.cachepath, key) + leasesuffix
+
+    def _takelease(self, key):
+        """Returns None if we now hold the lease on key, or the name of the
+        live ticket holding it."""
+        path = self._leasepath(key)
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o664)
+            except OSError as ex:
+                if ex.errno == errno.ENOENT:
+                    shallowutil.makedirs(self.cachepath,
+                                         os.path.dirname(path), self.uid)
+                    continue
+                if ex.errno != errno.EEXIST:
+                    raise
+            else:
+                try:
+                    os.write(fd, self._ticket)
+                finally:
+                    os.close(fd)
+                return None
+
+            try:
+                with open(path) as f:
+                    holder = f.read()
+            except IOError:
+                # released while we were looking; try again
+                continue
+            if not holder:
+                # the holder hasn't written its name yet, or died first
+                if time.time() - _mtime(path) > self.timeout:
+                    shallowutil.unlinkifexists(path)
+                else:
+                    time.sleep(0.01)
+                continue
+
+            if holder != self._ticket and self._alive(holder) is not None:
+                return holder
+
+            # the holder died without releasing its lease
+            shallowutil.unlinkifexists(path)
+
+    def begin(self, keys, priority, contains):
+        """Registers a fetch of keys. Returns the keys this process should
+        download itself; the rest are being downloaded by a fetch at least as
+        urgent and can be waited for with wait(). Keys that contains()
+        reports as already present, because another fetch just finished
+        them, are dropped."""
+        self.priority = priority
+
+        # tickets and leases are shared like the rest of the cache
+        oldumask = os.umask(0o002)
+        try:
+            return self._begin(keys, priority, contains)
+        finally:
+            os.umask(oldumask)
+
+    def _begin(self, keys, priority, contains):
+        global _counter
+        shallowutil.makedirs(self.cachepath, self.path, self.uid)
+
+        _counter += 1
+        name = '%d_%s_%d_%d' % (priority, self.hostname, os.getpid(), _counter)
+        open(os.path.join(self.path, name), 'w').close()
+        self._ticket = name
+        self._renewed = time.time()
+
+        owned = []
+        self._leases = []
+        self._inflight = {}
+        for key in keys:
+            holder = self._takelease(key)
+            if holder is None:
+                self._leases.append(key)
+                if not contains(key):
+                    owned.append(key)
+            elif _priority(holder) > priority:
+                # don't queue up behind a less urgent fetch
+                if not contains(key):
+                    owned.append(key)
+            else:
+                self._inflight[key] = holder
+
+        return owned
+
+    def renew(self):
+        """Called regularly while fetching, to show we are still alive."""
+        now = time.time()
+        if self._ticket and now - self._renewed > self.timeout / 4.0:
+            path = os.path.join(self.path, self._ticket)
+            try:
+                os.utime(path, None)
+            except OSError as ex:
+                if ex.errno == errno.ENOENT:
+                    # removed by someone who thought we died; we didn't
+                    try:
+                        open(path, 'w').close()
+                    except IOError:
+                        pass
+            self._renewed = now
+
+    def checkpoint(self):
+        """Called between batches of a fetch. Bulk fetches wait here while a
+        fetch with a higher priority is running."""
+        while any(priority < self.priority
+                  for name, priority in self._tickets()):
+            self.renew()
+            time.sleep(0.1)
+        self.renew()
+
+    def end(self):
+        """Releases the leases and the ticket taken by begin(). Leases another
+        process took over while we looked dead are left alone."""
+        for key in self._leases:
+            path = self._leasepath(key)
+            try:
+                with open(path) as f:
+                    holder = f.read()
+            except IOError:
+                continue
+            if holder == self._ticket:
+                shallowutil.unlinkifexists(path)
+        self._leases = []
+        if self._ticket:
+            shallowutil.unlinkifexists(os.path.join(self.path, self._ticket))
+            self._ticket = None
+
+    def wait(self, contains):
+        """Waits for the keys other processes were fetching when begin() was
+        called. Returns the ones that never arrived, because the process
+        fetching them died or failed."""
+        pending = dict(self._inflight)
+        self._inflight = {}
+        missing = []
+        alive = {}
+        delay = 0.01
+        while pending:
+            for key, holder in pending.items():
+                if contains(key):
+                    del pending[key]
+                    continue
+                if holder not in alive:
+                    alive[holder] = self._alive(holder) is not None
+                if not alive[holder]:
+                    missing.append(key)
+                    del pending[key]
+            if pending:
+                # back off, so waiting on a long fetch doesn't keep stating
+                # every pending key
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+                alive.clear()
+        return missing
+
+def _priority(name):
+    return int(name.split('_', 1)[0])
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0
@@ -8,6 +8,7 @@
 from mercurial.i18n import _
 from mercurial import util, sshpeer, hg, error, util
 import os, socket, lz4, time, grp
+import accesslog, fetchscheduler, renameindex, shallowutil
 
 # Statistics for debugging
 fetchcost = 0
@@ -17,19 +18,24 @@ fetchmisses = 0
 
 _downloading = _('downloading')
 
-def makedirs(root, path, owner):
-    os.makedirs(path)
-
-    while path != root:
-        stat = os.stat(path)
-        if stat.st_uid == owner:
-            os.chmod(path, 0o2775)
-        path = os.path.dirname(path)
+# suffix of the cache keys of blobs that only hold a file version's history
+historysuffix = '.history'
 
 def getcachekey(reponame, file, id):
     pathhash = util.sha1(file).hexdigest()
     return os.path.join(reponame, pathhash[:2], pathhash[2:], id)
 
+def gethistorykey(reponame, file, id):
+    """the cache key of a history-only blob, fetched by prefetchhistory()"""
+    return getcachekey(reponame, file, id) + historysuffix
+
+def _missingerror(missingids):
+    """the error for (file, hexnode) versions the server doesn't have, of the
+    same type remotefilelog raises for unknown nodes"""
+    file, id = missingids[0]
+    return error.LookupError(id, file,
+                             _("unable to download %d files") % len(missingids))
+
 def getlocalkey(file, id):
     pathhash = util.sha1(file).hexdigest()
     return os.path.join(pathhash, id)
@@ -99,13 +105,60 @@ class fileserverclient(object):
 
         self.localcache = localcache(repo)
         self.remotecache = cacheconnection()
-
-    def request(self, fileids):
+        self.scheduler = fetchscheduler.fetchscheduler(ui,
+                                                       self.localcache.cachepath)
+        self.negativecache = negativecache(ui, self.localcache.cachepath)
+        self.renameindex = renameindex.renameindex(repo)
+        self.accesslog = None
+        if ui.configbool("remotefilelog", "predictiveprefetch"):
+            self.accesslog = accesslog.accesslog(repo)
+
+    def request(self, fileids, priority=fetchscheduler.PRIORITY_DEMAND,
+                history=False):
         """Takes a list of filename/node pairs and fetches them from the
         server. Files are stored in the local cache.
         A list of nodes that the server couldn't find is returned.
         If the connection fails, an exception is raised.
+
+        Versions that another process sharing the cache is already
+        downloading are waited for instead of being downloaded again.
+
+        If history is True, only the history of the versions is fetched,
+        unless the server can only send whole blobs.
         """
+        reponame = self.repo.name
+        localcache = self.localcache
+        if history:
+            keyfn = gethistorykey
+            # the full blob holds the history too
+            contains = lambda key: (key in localcache or
+                key[:-len(historysuffix)] in localcache)
+        else:
+            keyfn = getcachekey
+            contains = localcache.__contains__
+
+        bykey = {}
+        for file, id in fileids:
+            bykey[keyfn(reponame, file, id)] = (file, id)
+
+        scheduler = self.scheduler
+        owned = scheduler.begin(list(bykey), priority, contains)
+        try:
+            missing = self._request([bykey[key] for key in owned], priority,
+                                    history)
+        finally:
+            scheduler.end()
+
+        retry = scheduler.wait(contains)
+        if retry:
+            missing.extend(self.request([bykey[key] for key in retry],
+                                        priority, history))
+        return missing
+
+    def _request(self, fileids, priority, history=False):
+        if not fileids:
+            return []
+
         if not self.remotecache.connected:
             self.connect()
         cache = self.remotecache
@@ -116,10 +169,11 @@ class fileserverclient(object):
         request = "get\n%d\n" % count
         idmap = {}
         reponame = repo.name
+        keyfn = gethistorykey if history else getcachekey
         for file, id in fileids:
-            fullid = getcachekey(reponame, file, id)
+            fullid = keyfn(reponame, file, id)
             request += fullid + "\n"
-            idmap[fullid] = file
+            idmap[fullid] = (file, id)
 
         cache.request(request)
 
@@ -127,8 +181,6 @@ class fileserverclient(object):
         total = count
         self.ui.progress(_downloading, 0, total=count)
 
-        fallbackpath = repo.fallbackpath
-
         missed = []
         count = 0
         while True:
@@ -148,6 +200,7 @@ class fileserverclient(object):
                 parts = missingid.split("_")
                 count += int(parts[2])
                 self.ui.progress(_downloading, count, total=total)
+                self.scheduler.renew()
                 continue
 
             missed.append(missingid)
@@ -162,47 +215,50 @@ class fileserverclient(object):
         try:
             # receive cache misses from master
             if missed:
-                verbose = self.ui.verbose
-                try:
-                    # When verbose is true, sshpeer prints 'running ssh...'
-                    # to stdout, which can interfere with some command
-                    # outputs
-                    self.ui.verbose = False
-
-                    if not fallbackpath:
-                        raise util.Abort("no remotefilelog server configured - "
-                            "is your .hg/hgrc trusted?")
-                    remote = hg.peer(self.ui, {}, fallbackpath)
-                    remote._callstream("getfiles")
-                finally:
-                    self.ui.verbose = verbose
-
-                i = 0
-                while i < len(missed):
+                remote = self._connectserver()
+                if history and not remote.capable('gethistory'):
+                    # fetch whole blobs instead, which hold the history too
+                    history = False
+                    suffix = len(historysuffix)
+                    idmap = dict((m[:-suffix], idmap[m]) for m in missed)
+                    missed = [m[:-suffix] for m in missed]
+                remote._callstream("gethistory" if history else "getfiles")
+
+                failed = set()
+                for start in xrange(0, len(missed), 10000):
+                    # let more urgent fetches from other processes go first
+                    if priority != fetchscheduler.PRIORITY_DEMAND:
+                        self.scheduler.checkpoint()
+
                     # issue a batch of requests
-                    start = i
                     end = min(len(missed), start + 10000)
-                    i = end
                     for missingid in missed[start:end]:
                         # issue new request
-                        versionid = missingid[-40:]
-                        file = idmap[missingid]
+                        file, versionid = idmap[missingid]
                         sshrequest = "%s%s\n" % (versionid, file)
                         remote.pipeo.write(sshrequest)
                     remote.pipeo.flush()
 
                     # receive batch results
                     for j in range(start, end):
-                        self.receivemissing(remote.pipei, missed[j])
+                        data = self.receivemissing(remote.pipei, missed[j])
+                        if data is None:
+                            # the server doesn't have this version
+                            failed.add(missed[j])
+                            missing.append(idmap[missed[j]])
+                            continue
+                        self.renameindex.addblob(idmap[missed[j]][0], data)
                         count += 1
                         self.ui.progress(_downloading, count, total=total)
+                        self.scheduler.renew()
 
                 remote.cleanup()
                 remote = None
+                self.renameindex.flush()
 
                 # send to memcache
-                count = len(missed)
-                request = "set\n%d\n%s\n" % (count, "\n".join(missed))
+                fetched = [m for m in missed if m not in failed]
+                request = "set\n%d\n%s\n" % (len(fetched), "\n".join(fetched))
                 cache.request(request)
 
             self.ui.progress(_downloading, None)
@@ -214,15 +270,37 @@ class fileserverclient(object):
 
         return missing
 
+    def _connectserver(self):
+        """opens a connection to the fallbackpath server"""
+        fallbackpath = self.repo.fallbackpath
+        verbose = self.ui.verbose
+        try:
+            # When verbose is true, sshpeer prints 'running ssh...'
+            # to stdout, which can interfere with some command
+            # outputs
+            self.ui.verbose = False
+
+            if not fallbackpath:
+                raise util.Abort("no remotefilelog server configured - "
+                    "is your .hg/hgrc trusted?")
+            remote = hg.peer(self.ui, {}, fallbackpath)
+        finally:
+            self.ui.verbose = verbose
+        return remote
+
     def receivemissing(self, pipe, missingid):
         line = pipe.readline()[:-1]
         if not line:
             raise error.ResponseError(_("error downloading file " +
                 "contents: connection closed early\n"), '')
+        if line == shallowutil.missingreply:
+            return None
         size = int(line)
         data = pipe.read(size)
 
-        self.localcache.write(missingid, lz4.decompress(data))
+        data = lz4.decompress(data)
+        self.localcache.write(missingid, data)
+        return data
 
     def connect(self):
         if self.cacheprocess:
@@ -265,11 +343,13 @@ class fileserverclient(object):
                     float(fetched - fetchmisses) / float(fetched) * 100.0,
                     fetchcost))
 
+        self.renameindex.flush()
         if self.remotecache.connected:
             self.remotecache.close()
 
-    def prefetch(self, fileids, force=False):
-        """downloads the given file versions to the cache
+    def missing(self, fileids, force=False):
+        """returns the subset of the given file versions that would need to
+        be downloaded, in the same (file, hexnode) form
         """
         repo = self.repo
         localcache = self.localcache
@@ -294,15 +374,117 @@ class fileserverclient(object):
 
             missingids.append((file, id))
 
+        return missingids
+
+    def prefetch(self, fileids, force=False,
+                 priority=fetchscheduler.PRIORITY_DEMAND):
+        """downloads the given file versions to the cache
+
+        Bulk prefetches should pass PRIORITY_BULK, so they pause while an on
+        demand fetch from another process is running.
+        """
+        self._fetch(self.missing(fileids, force=force), priority)
+
+    def prefetchhistory(self, fileids, force=False,
+                        priority=fetchscheduler.PRIORITY_DEMAND):
+        """downloads just the history of the given file versions to the
+        cache, for callers that don't need their contents
+
+        Falls back to a full prefetch if the server doesn't support history
+        requests.
+        """
+        reponame = self.repo.name
+        localcache = self.localcache
+        missingids = [(file, id) for file, id in self.missing(fileids, force)
+                      if gethistorykey(reponame, file, id) not in localcache]
+        self._fetch(missingids, priority, history=True)
+
+    def _fetch(self, missingids, priority, history=False):
         if missingids:
-            global fetches, fetched, fetchcost
-            fetches += 1
-            fetched += len(missingids)
-            start = time.time()
-            missingids = self.request(missingids)
-            if missingids:
-                raise util.Abort(_("unable to download %d files") % len(missingids))
-            fetchcost += time.time() - start
+            # don't ask again for versions the server recently said it
+            # doesn't have
+            reponame = self.repo.name
+            negativecache = self.negativecache
+            known = []
+            fetch = []
+            for file, id in missingids:
+                if getcachekey(reponame, file, id) in negativecache:
+                    known.append((file, id))
+                else:
+                    fetch.append((file, id))
+
+            if fetch:
+                global fetches, fetched, fetchcost
+                fetches += 1
+                fetched += len(fetch)
+                start = time.time()
+                notfound = self.request(fetch, priority=priority,
+                                        history=history)
+                fetchcost += time.time() - start
+                for file, id in notfound:
+                    negativecache.add(getcachekey(reponame, file, id))
+                known.extend(notfound)
+
+            if known:
+                raise _missingerror(known)
+
+# directory inside the cachepath holding the on disk negative cache
+negativecachedir = '.missing'
+
+class negativecache(object):
+    """Remembers, for remotefilelog.negativecachettl seconds, the cache keys
+    the server reported as missing, so repeated lookups of versions it
+    doesn't have (like those of stripped local commits) fail without asking
+    it again.
+
+    Entries are kept in memory, and also in <cachepath>/.missing when
+    remotefilelog.negativecacheondisk is set, so later commands benefit too.
+    A ttl of 0 disables the cache.
+    """
+    def __init__(self, ui, cachepath):
+        self.ttl = ui.configint("remotefilelog", "negativecachettl", 60)
+        self.path = None
+        if ui.configbool("remotefilelog", "negativecacheondisk"):
+            self.path = os.path.join(cachepath, negativecachedir)
+        self._entries = {}
+
+    def _keypath(self, key):
+        return os.path.join(self.path, util.sha1(key).hexdigest())
+
+    def __contains__(self, key):
+        if self.ttl <= 0:
+            return False
+
+        now = time.time()
+        expires = self._entries.get(key)
+        if expires is None and self.path:
+            try:
+                expires = os.stat(self._keypath(key)).st_mtime + self.ttl
+            except OSError:
+                pass
+        if expires is None:
+            return False
+
+        if expires <= now:
+            self._entries.pop(key, None)
+            return False
+        self._entries[key] = expires
+        return True
+
+    def add(self, key):
+        if self.ttl <= 0:
+            return
+
+        self._entries[key] = time.time() + self.ttl
+        if self.path:
+            try:
+                if not os.path.exists(self.path):
+                    os.makedirs(self.path)
+                    os.chmod(self.path, 0o2775)
+                open(self._keypath(key), 'w').close()
+            except (IOError, OSError):
+                # the on disk copy is only an optimization
+                pass
 
 class localcache(object):
     def __init__(self, repo):
@@ -341,7 +523,7 @@ class localcache(object):
         path = os.path.join(self.cachepath, key)
         dirpath = os.path.dirname(path)
         if not os.path.exists(dirpath):
-            makedirs(self.cachepath, dirpath, self.uid)
+            shallowutil.makedirs(self.cachepath, dirpath, self.uid)
 
         f = None
         try:
@@ -433,12 +615,33 @@ class localcache(object):
 
         ui.progress(_removing, count, unit="files")
         for root, dirs, files in os.walk(cachepath):
+            if root == cachepath and fetchscheduler.ticketdir in dirs:
+                dirs.remove(fetchscheduler.ticketdir)
+            if root == os.path.join(cachepath, negativecachedir):
+                # negative entries are only useful for a few minutes
+                for file in files:
+                    path = os.path.join(root, file)
+                    try:
+                        if os.stat(path).st_mtime < limit:
+                            os.remove(path)
+                    except OSError:
+                        pass
+                continue
             for file in files:
                 if file == 'repos':
                     continue
 
                 ui.progress(_removing, count, unit="files")
                 path = os.path.join(root, file)
+                if file.endswith(fetchscheduler.leasesuffix):
+                    # only remove leases abandoned by crashed processes
+                    try:
+                        if os.stat(path).st_mtime < limit:
+                            os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+
                 key = os.path.relpath(path, cachepath)
                 count += 1
                 stat = os.stat(path)
@@ -0,0 +1,160 @@
+# pathindex.py - maps file paths to the changesets that touch them
+#
+# Copyright 2016 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+from mercurial.i18n import _
+from mercurial import error, lock as lockmod, util
+import errno, os
+
+# The index lives in .hg/pathindex. For every path there is a file, named
+# after the hash of the path like the local blob directories, holding the
+# 20 byte nodes of the changesets whose files list contains the path. The
+# 'nodes' file holds the node of every indexed changelog rev, in rev order,
+# so updates know where to resume and notice when a strip replaced revs.
+indexdir = 'pathindex'
+nodesfile = 'nodes'
+lockfile = 'pathindex.lock'
+
+_indexing = _('indexing paths')
+
+def enabled(repo):
+    return repo.ui.configbool('remotefilelog', 'pathindex')
+
+class pathindex(object):
+    """An on disk index from file paths to the changelog revs touching them,
+    brought up to date incrementally as the changelog grows.
+
+    Entries are changeset nodes rather than revs, so a strip can't make the
+    index lie: nodes that are no longer in the changelog are ignored.
+    """
+    def __init__(self, repo):
+        self.repo = repo.unfiltered()
+        self.path = self.repo.vfs.join(indexdir)
+        self.chunksize = self.repo.ui.configint('remotefilelog',
+                                                'pathindexchunksize', 10000)
+        self._uptodate = None
+
+    def _pathfile(self, path):
+        pathhash = util.sha1(path).hexdigest()
+        return os.path.join(self.path, pathhash[:2], pathhash[2:])
+
+    def _indexedcount(self, cl):
+        """returns how many changelog revs, starting from 0, are indexed"""
+        nodespath = os.path.join(self.path, nodesfile)
+        try:
+            f = open(nodespath, 'rb')
+        except IOError:
+            return 0
+
+        with f:
+            f.seek(0, os.SEEK_END)
+            count = min(f.tell() // 20, len(cl))
+            if not count:
+                return 0
+            f.seek((count - 1) * 20)
+            if f.read(20) == cl.node(count - 1):
+                return count
+
+            # A strip replaced the end of the changelog. Find where the
+            # indexed nodes stop matching it.
+            f.seek(0)
+            data = f.read(count * 20)
+
+        node = cl.node
+        for rev in xrange(count):
+            if data[rev * 20:(rev + 1) * 20] != node(rev):
+                return rev
+        return count
+
+    def update(self):
+        """Indexes the changesets added since the last update. Returns False
+        if the index couldn't be brought up to date, for example because the
+        repo isn't writable."""
+        cl = self.repo.changelog
+        key = (len(cl), cl.tip())
+        if self._uptodate == key:
+            return True
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            l = lockmod.lock(self.repo.vfs, lockfile)
+        except (IOError, OSError, error.LockError):
+            return False
+
+        try:
+            self._index(cl)
+        except (IOError, OSError):
+            return False
+        finally:
+            l.release()
+
+        self._uptodate = key
+        return True
+
+    def _index(self, cl):
+        ui = self.repo.ui
+        start = self._indexedcount(cl)
+        end = len(cl)
+
+        nodespath = os.path.join(self.path, nodesfile)
+        with open(nodespath, 'ab') as f:
+            # forget the nodes of stripped revs
+            f.truncate(start * 20)
+
+        for chunkstart in xrange(start, end, self.chunksize):
+            chunkend = min(chunkstart + self.chunksize, end)
+            ui.progress(_indexing, chunkstart - start, unit="changesets",
+                        total=end - start)
+
+            nodes = []
+            touched = {}
+            for rev in xrange(chunkstart, chunkend):
+                node = cl.node(rev)
+                nodes.append(node)
+                for path in cl.read(node)[3]:
+                    touched.setdefault(path, []).append(node)
+
+            # Path files are written before the nodes file, so an interrupted
+            # update is redone on the next one. That may repeat some entries,
+            # which revs() tolerates.
+            for path, pathnodes in touched.iteritems():
+                pathfile = self._pathfile(path)
+                try:
+                    f = open(pathfile, 'ab')
+                except IOError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    os.makedirs(os.path.dirname(pathfile))
+                    f = open(pathfile, 'ab')
+                with f:
+                    f.write(''.join(pathnodes))
+
+            with open(nodespath, 'ab') as f:
+                f.write(''.join(nodes))
+        ui.progress(_indexing, None)
+
+    def revs(self, path):
+        """returns the sorted changelog revs touching path, or None if the
+        index isn't available"""
+        if not self.update():
+            return None
+
+        try:
+            with open(self._pathfile(path), 'rb') as f:
+                data = f.read()
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                return None
+            return []
+
+        nodemap = self.repo.changelog.nodemap
+        revs = set()
+        for offset in xrange(0, len(data), 20):
+            rev = nodemap.get(data[offset:offset + 20])
+            if rev is not None:
+                revs.add(rev)
+        return sorted(revs)
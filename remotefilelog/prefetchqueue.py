@@ -0,0 +1,192 @@
+# prefetchqueue.py - resumable queue of pending prefetches
+#
+# Copyright 2016 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+from mercurial.i18n import _
+from mercurial import error, lock as lockmod
+from mercurial.node import hex
+import fetchscheduler, fileserverclient, shallowutil
+import os
+
+# The queue is an append-only file in .hg with one "<kind> <hexnode> <path>\n"
+# line per file version, where kind is 's' for versions that must come from
+# the server and 'l' for versions that may already be local. The progress
+# file holds the offset of the first line that hasn't been fetched yet, so an
+# interrupted prefetch resumes where it stopped.
+queuefile = 'prefetchqueue'
+progressfile = 'prefetchqueue.progress'
+# held briefly by anyone changing the queue file
+queuelockfile = 'prefetchqueue.lock'
+# held by the process working through the queue
+worklockfile = 'prefetch.lock'
+# where a background prefetch writes its output
+logfile = 'prefetch.log'
+
+def enqueue(repo, serverfiles, files):
+    """Adds (path, node) pairs to the queue. serverfiles are fetched from the
+    server even if a local version exists."""
+    lines = ["s %s %s\n" % (hex(node), path) for path, node in serverfiles]
+    lines.extend("l %s %s\n" % (hex(node), path) for path, node in files)
+    if not lines:
+        return
+
+    l = lockmod.lock(repo.vfs, queuelockfile)
+    try:
+        f = repo.vfs(queuefile, 'a')
+        try:
+            f.write(''.join(lines))
+        finally:
+            f.close()
+    finally:
+        l.release()
+
+def _readprogress(repo):
+    try:
+        return int(repo.vfs.read(progressfile))
+    except (IOError, ValueError):
+        return 0
+
+def _readchunk(repo, offset, chunksize):
+    """Returns the entries starting at offset, and the offset after them."""
+    serverfiles = []
+    files = []
+    try:
+        f = repo.vfs(queuefile, 'r')
+    except IOError:
+        return serverfiles, files, offset
+
+    with f:
+        f.seek(offset)
+        while len(serverfiles) + len(files) < chunksize:
+            line = f.readline()
+            if not line.endswith('\n'):
+                # end of the queue, or a line that is still being written
+                break
+            offset += len(line)
+            kind, id, path = line[:-1].split(' ', 2)
+            if kind == 's':
+                serverfiles.append((path, id))
+            else:
+                files.append((path, id))
+
+    return serverfiles, files, offset
+
+def _writeprogress(repo, offset):
+    f = repo.vfs(progressfile, 'w', atomictemp=True)
+    try:
+        f.write('%d' % offset)
+    finally:
+        f.close()
+
+def _unlink(repo, name):
+    shallowutil.unlinkifexists(repo.vfs.join(name))
+
+def _queuesize(repo):
+    try:
+        return os.path.getsize(repo.vfs.join(queuefile))
+    except OSError:
+        return 0
+
+def fetch(repo, serverfiles, files, priority=fetchscheduler.PRIORITY_BULK):
+    """Fetches (path, hexnode) pairs without going through the queue.
+    serverfiles are fetched from the server even if a local version exists.
+
+    Both lists are attempted even if the first one fails; a LookupError for
+    versions the server doesn't have is raised afterwards."""
+    fileservice = repo.fileservice
+    failure = None
+    # Fetch files known to be on the server
+    if serverfiles:
+        try:
+            fileservice.prefetch(serverfiles, force=True, priority=priority)
+        except error.LookupError as inst:
+            failure = inst
+    # Fetch files that may or may not be on the server
+    if files:
+        fileservice.prefetch(files, priority=priority)
+    if failure:
+        raise failure
+
+def run(repo, wait=True):
+    """Fetches everything in the queue, in chunks, recording progress after
+    each chunk.
+
+    Only one process works through the queue at a time. If another one is
+    already doing so and wait is False, this returns immediately. Anything
+    queued before returning will be fetched by that process, so concurrent
+    prefetches coalesce into one.
+
+    A chunk containing versions the server doesn't have is reported and
+    skipped, so it can't block everything queued after it.
+    """
+    try:
+        worklock = lockmod.lock(repo.vfs, worklockfile, -1 if wait else 0)
+    except error.LockHeld:
+        return
+
+    chunksize = repo.ui.configint('remotefilelog', 'prefetchchunksize', 10000)
+    try:
+        while True:
+            offset = _readprogress(repo)
+            serverfiles, files, offset = _readchunk(repo, offset, chunksize)
+            if serverfiles or files:
+                try:
+                    fetch(repo, serverfiles, files)
+                except error.LookupError as inst:
+                    repo.ui.warn(_("warning: could not fetch queued "
+                                   "files: %s\n") % inst)
+
+                _writeprogress(repo, offset)
+                continue
+
+            # The queue looks drained. Check again while holding the queue
+            # lock, and give up the work lock before the queue lock, so
+            # anything enqueued after this point finds the work lock free.
+            queuelock = lockmod.lock(repo.vfs, queuelockfile)
+            try:
+                if _queuesize(repo) > offset:
+                    continue
+                _unlink(repo, queuefile)
+                _unlink(repo, progressfile)
+                worklock.release()
+                worklock = None
+                return
+            finally:
+                queuelock.release()
+    finally:
+        if worklock:
+            worklock.release()
+
+def runbackground(repo):
+    """Works through the queue in a detached, low priority child process.
+    Returns immediately in the parent. The child's output is appended to
+    .hg/prefetch.log."""
+    if os.fork():
+        return
+
+    try:
+        os.setsid()
+        os.nice(10)
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        try:
+            log = os.open(repo.vfs.join(logfile),
+                          os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        except OSError:
+            log = os.open(os.devnull, os.O_WRONLY)
+        for fd in (1, 2):
+            os.dup2(log, fd)
+
+        # The parent owns the cache process connection; open our own.
+        repo.fileservice.remotecache = fileserverclient.cacheconnection()
+        try:
+            run(repo, wait=False)
+        finally:
+            repo.fileservice.close()
+            repo.ui.flush()
+    finally:
+        os._exit(0)
@@ -5,12 +5,44 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2 or any later version.
 
-import collections, os
+import remotefilelog
+import collections, heapq, os
 from mercurial.node import bin, hex, nullid, nullrev, short
 from mercurial import revlog, mdiff, filelog, context, util, error, ancestor
 
 propertycache = util.propertycache
 
+def ancestorrecords(ancestormap, path, node, clrev, followfirst=False):
+    """returns the (path, node, linkrev) of every ancestor of the given file
+    version in ancestormap, sorted by decreasing linkrev"""
+    records = []
+    queue = collections.deque([(path, node)])
+    seen = set(queue)
+    while queue:
+        path, node = queue.popleft()
+        p1, p2, linknode, copyfrom = ancestormap[node]
+        records.append((path, node, clrev(linknode)))
+
+        if p1 != nullid:
+            parent = (copyfrom or path, p1)
+            if parent not in seen:
+                seen.add(parent)
+                queue.append(parent)
+
+        if p2 != nullid and not followfirst:
+            parent = (path, p2)
+            if parent not in seen:
+                seen.add(parent)
+                queue.append(parent)
+
+    # Remove self
+    records.pop(0)
+
+    # Sort by linkrev
+    # The copy tracing algorithm depends on these coming out in order
+    records.sort(reverse=True, key=lambda x: x[2])
+    return records
+
 class remotefilectx(context.filectx):
     def __init__(self, repo, path, changeid=None, fileid=None,
                  filelog=None, changectx=None, ancestormap=None):
@@ -46,7 +78,13 @@ class remotefilectx(context.filectx):
 
         ancestormap = self.ancestormap()
         p1, p2, linknode, copyfrom = ancestormap[self._fileid]
-        return self._repo.changelog.rev(linknode)
+        return self._linkrevfn(linknode)
+
+    @propertycache
+    def _linkrevfn(self):
+        # Built once per filectx rather than per linkrev() call. Filectxs
+        # created by parents() and ancestors() share their creator's.
+        return remotefilelog.linkrevfn(self._repo)
 
     def renamed(self):
         """check if file was actually renamed in this changeset revision
@@ -55,6 +93,12 @@ class remotefilectx(context.filectx):
         if file revisions linkrev points back to the changeset in question
         or both changeset parents contain different file revisions.
         """
+        if (self._ancestormap is None and
+            self._repo.fileservice.renameindex.get(self._path,
+                                                   self._filenode) is False):
+            # known not to be a copy, no need for the history
+            return None
+
         ancestormap = self.ancestormap()
 
         p1, p2, linknode, copyfrom = ancestormap[self._filenode]
@@ -104,6 +148,7 @@ class remotefilectx(context.filectx):
             flog = repo.file(path)
             p1ctx = remotefilectx(repo, path, fileid=p1, filelog=flog,
                                   ancestormap=ancestormap)
+            p1ctx._linkrevfn = self._linkrevfn
             results.append(p1ctx)
 
         if p2 != nullid:
@@ -111,39 +156,35 @@ class remotefilectx(context.filectx):
             flog = repo.file(path)
             p2ctx = remotefilectx(repo, path, fileid=p2, filelog=flog,
                                   ancestormap=ancestormap)
+            p2ctx._linkrevfn = self._linkrevfn
             results.append(p2ctx)
 
         return results
 
+    def ancestorrecords(self, followfirst=False):
+        """returns the (path, node, linkrev) of every ancestor, newest first
+
+        This is what ancestors() yields filectxs for, for callers that only
+        need paths and linkrevs.
+        """
+        return ancestorrecords(self.ancestormap(), self.path(),
+                               self.filenode(), self._linkrevfn,
+                               followfirst=followfirst)
+
     def ancestors(self, followfirst=False):
         repo = self._repo
         ancestormap = self.ancestormap()
-        clrev = repo.changelog.rev
-
-        ancestors = []
-        queue = [(self.path(), self.filenode())]
-        while queue:
-            path, node = queue.pop(0)
-            p1, p2, linknode, copyfrom = ancestormap[node]
-            ancestors.append((path, node, clrev(linknode)))
 
-            if p1 != nullid:
-                queue.append((copyfrom or path, p1))
-
-            if p2 != nullid and not followfirst:
-                queue.append((path, p2))
-
-        # Remove self
-        ancestors.pop(0)
-
-        # Sort by linkrev
-        # The copy tracing algorithm depends on these coming out in order
-        ancestors = sorted(ancestors, reverse=True, key=lambda x:x[2])
-
-        for path, node, _ in ancestors:
-            flog = repo.file(path)
-            yield remotefilectx(repo, path, fileid=node, filelog=flog,
-                                ancestormap=ancestormap)
+        clrev = self._linkrevfn
+        filelogs = {}
+        for path, node, linkrev in self.ancestorrecords(followfirst):
+            flog = filelogs.get(path)
+            if flog is None:
+                flog = filelogs[path] = repo.file(path)
+            fctx = remotefilectx(repo, path, fileid=node, filelog=flog,
+                                 ancestormap=ancestormap)
+            fctx._linkrevfn = clrev
+            yield fctx
 
     def ancestor(self, fc2, actx):
         # the easy case: no (relevant) renames
@@ -187,15 +228,140 @@ class remotefilectx(context.filectx):
         else:
             base = self
 
-        fetch = []
-        ancestors = base.ancestors()
-        for ancestor in ancestors:
-            fetch.append((ancestor.path(), hex(ancestor.filenode())))
+        if self._repo.ui.configbool('remotefilelog', 'streamingannotate'):
+            return base._streamannotate(follow, linenumber, diffopts)
+
+        fetch = [(path, hex(node))
+                 for path, node, linkrev in base.ancestorrecords()]
 
         self._repo.fileservice.prefetch(fetch)
 
         return super(remotefilectx, self).annotate(follow, linenumber, diffopts)
 
+    def _streamannotate(self, follow, linenumber, diffopts):
+        """annotates by walking the history newest first, handing each line
+        down to the parent it came from until it reaches the revision that
+        introduced it
+
+        Revisions are fetched in batches, in the order the walk will visit
+        them, and the walk stops as soon as every line has been attributed,
+        so the old history of a file whose lines all changed recently is
+        never downloaded.
+        """
+        repo = self._repo
+        ancestormap = self.ancestormap()
+        clrev = self._linkrevfn
+        batchsize = repo.ui.configint('remotefilelog', 'annotatebatchsize',
+                                      100)
+
+        def parents(path, node):
+            p1, p2, linknode, copyfrom = ancestormap[node]
+            result = []
+            if p1 != nullid and (follow or not copyfrom):
+                result.append((copyfrom or path, p1))
+            if p2 != nullid:
+                result.append((path, p2))
+            return result
+
+        def linkrev(node):
+            return clrev(ancestormap[node][2])
+
+        # every revision the walk may visit, in the order it visits them
+        start = (self.path(), self.filenode())
+        order = [start]
+        seen = set(order)
+        for key in order:
+            for parent in parents(*key):
+                if parent not in seen:
+                    seen.add(parent)
+                    order.append(parent)
+        order.sort(key=lambda key: linkrev(key[1]), reverse=True)
+
+        fetched = set()
+        position = [0]
+        def fetch(keys):
+            needed = [key for key in keys if key not in fetched]
+            if not needed:
+                return
+            # also fetch the revisions the walk is likely to need next
+            while len(needed) < batchsize and position[0] < len(order):
+                key = order[position[0]]
+                position[0] += 1
+                if key not in fetched and key not in needed:
+                    needed.append(key)
+            repo.fileservice.prefetch([(path, hex(node))
+                                       for path, node in needed])
+            fetched.update(needed)
+
+        if linenumber is None:
+            decorate = lambda fctx, i: fctx
+        elif linenumber:
+            decorate = lambda fctx, i: (fctx, i + 1)
+        else:
+            decorate = lambda fctx, i: (fctx, False)
+
+        fetch([start])
+        lines = self.data().splitlines(True)
+        result = [None] * len(lines)
+
+        # (path, node) -> [(index in result, index in that revision's text)]
+        pending = {start: [(i, i) for i in xrange(len(lines))]}
+        texts = {start: self.data()}
+        heap = [(-self.linkrev(), start)]
+        while heap:
+            rev, key = heapq.heappop(heap)
+            keylines = pending.pop(key)
+            path, node = key
+            if key == start:
+                fctx = self
+            else:
+                fctx = remotefilectx(repo, path, fileid=node,
+                                     filelog=repo.file(path),
+                                     ancestormap=ancestormap)
+
+            pl = parents(path, node)
+            fetch([key] + pl)
+            text = texts.pop(key, None)
+            if text is None:
+                text = fctx.data()
+
+            # the later parent wins for lines both parents have, like in
+            # core annotate
+            matches = []
+            for parent in pl:
+                parenttext = texts.get(parent)
+                if parenttext is None:
+                    ppath, pnode = parent
+                    parenttext = repo.file(ppath).read(pnode)
+                    texts[parent] = parenttext
+                matched = {}
+                for (a1, a2, b1, b2), t in mdiff.allblocks(parenttext, text,
+                                                           opts=diffopts):
+                    if t == '=':
+                        for offset in xrange(b2 - b1):
+                            matched[b1 + offset] = a1 + offset
+                matches.append((parent, matched))
+            matches.reverse()
+
+            for resultindex, index in keylines:
+                for parent, matched in matches:
+                    parentindex = matched.get(index)
+                    if parentindex is not None:
+                        if parent not in pending:
+                            pending[parent] = []
+                            heapq.heappush(heap, (-linkrev(parent[1]), parent))
+                        pending[parent].append((resultindex, parentindex))
+                        break
+                else:
+                    result[resultindex] = decorate(fctx, index)
+
+            # drop the texts of parents no line was handed down to
+            for parent in pl:
+                if parent not in pending:
+                    texts.pop(parent, None)
+
+        return zip(result, lines)
+
     def cmp(self, fctx):
         """compare with other file context
 
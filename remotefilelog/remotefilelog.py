@@ -6,7 +6,7 @@
 # GNU General Public License version 2 or any later version.
 
 import fileserverclient
-import collections, os, shutil
+import bisect, collections, os, shutil
 from mercurial.node import bin, hex, nullid, nullrev
 from mercurial import revlog, mdiff, filelog, ancestor, error
 from mercurial.i18n import _
@@ -25,17 +25,107 @@ def _readfile(path):
     finally:
         f.close()
 
-def _writefile(path, content):
+def _writefile(path, writer):
+    """creates the file at path, and has writer(fileobj) stream its content"""
     dirname = os.path.dirname(path)
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
     f = open(path, "w")
     try:
-        f.write(content)
+        writer(f)
     finally:
         f.close()
 
+def _alternates(path):
+    """yields the paths of the past versions of the local blob at path, oldest
+    first
+
+    add() saves them next to the blob as <node>1, <node>2, ..., so they are
+    found by probing those names in order instead of listing the directory,
+    which can hold thousands of blobs for hot files.
+    """
+    i = 1
+    while True:
+        alternatepath = path + str(i)
+        if not os.path.exists(alternatepath):
+            return
+        yield alternatepath
+        i += 1
+
+def _changelogcache(repo, name):
+    """returns the named dict cached on repo for the current state of its
+    changelog
+
+    The dict is replaced by an empty one whenever the changelog changes,
+    including by a strip, so it can hold anything derived from changelog
+    revs or nodes.
+    """
+    cl = repo.changelog
+    generation = (len(cl), cl.tip(), len(cl.filteredrevs))
+    unfi = repo.unfiltered()
+    caches = unfi.__dict__.setdefault('_changelogcaches', {})
+    key = (repo.filtername, name)
+    cached = caches.get(key)
+    if cached is None or cached[0] != generation:
+        cached = (generation, {})
+        caches[key] = cached
+    return cached[1]
+
+def linkrevfn(repo):
+    """returns a function mapping linknodes to changelog revs, that remembers
+    its answers until the changelog changes
+
+    History walks convert the same linknodes over and over, for sorting and
+    range checks; this turns each one after the first into a dict lookup.
+    """
+    linkrevs = _changelogcache(repo, 'linkrevs')
+    clrev = repo.changelog.rev
+
+    def linkrev(linknode):
+        rev = linkrevs.get(linknode)
+        if rev is None:
+            rev = linkrevs[linknode] = clrev(linknode)
+        return rev
+    return linkrev
+
+def _linknodecheckers(repo):
+    """returns (isvalid, isancestor) functions for checking linknodes against
+    the changelog of repo
+
+    isvalid(node) tells whether node is a visible changeset, and
+    isancestor(a, b) whether changeset a is an ancestor of (or is) b. Answers
+    are cached on the repo until its changelog changes, since validating the
+    ancestormap of every file of a large commit asks the same questions over
+    and over.
+    """
+    cl = repo.changelog
+    valid = _changelogcache(repo, 'validlinknodes')
+    ancestry = _changelogcache(repo, 'linknodeancestry')
+
+    nodemap = cl.nodemap
+    filteredrevs = cl.filteredrevs
+
+    def isvalid(node):
+        result = valid.get(node)
+        if result is None:
+            rev = nodemap.get(node)
+            result = rev is not None and rev not in filteredrevs
+            valid[node] = result
+        return result
+
+    def isancestor(a, b):
+        result = ancestry.get((a, b))
+        if result is None:
+            # cl.ancestor walks the index in C, which matters when a is
+            # hundreds of thousands of revs behind b
+            result = (cl.rev(a) <= cl.rev(b) and
+                      cl.ancestor(a, b) == a)
+            ancestry[(a, b)] = result
+        return result
+
+    return isvalid, isancestor
+
 def _createrevlogtext(text, copyfrom=None, copyrev=None):
     """returns a string that matches the revlog contents in a
     traditional revlog
@@ -56,6 +146,75 @@ def _parsemeta(text):
         text = text[s + 2:]
     return meta or {}, text
 
+def ancestormaps(repo, fileids, relativeto=None):
+    """Returns a {(path, node): ancestormap} dict for the given (path, node)
+    pairs. The history of every version that isn't available locally is
+    fetched in a single batch, instead of one fetch per file.
+    """
+    repo.fileservice.prefetchhistory([(path, hex(node))
+                                      for path, node in fileids])
+
+    results = {}
+    filelogs = {}
+    for path, node in fileids:
+        flog = filelogs.get(path)
+        if flog is None:
+            flog = filelogs[path] = repo.file(path)
+        results[(path, node)] = flog.ancestormap(node, relativeto=relativeto)
+    return results
+
+class revgraph(object):
+    """A numeric DAG of versions of a file, for ancestor computations.
+
+    Versions are numbered parents first, as revlogs do, so the generic
+    algorithms in mercurial.ancestor apply. Since a version's parents are
+    part of its hash, the numbering never has to change; versions are simply
+    appended as ancestor queries reach them. Renames aren't followed;
+    remotefilectx.ancestor does that.
+    """
+    def __init__(self):
+        self.revs = {}
+        self.nodes = []
+        self._parentrevs = []
+
+    def parentrevs(self, rev):
+        return self._parentrevs[rev]
+
+    def add(self, node, ancestormap):
+        """numbers node and its ancestors in ancestormap, returns the rev of
+        node"""
+        revs = self.revs
+
+        def parents(node):
+            p1, p2, linknode, copyfrom = ancestormap[node]
+            result = []
+            if p1 != nullid and not copyfrom:
+                result.append(p1)
+            if p2 != nullid:
+                result.append(p2)
+            return result
+
+        # iterative post-order walk, so parents get numbered first
+        stack = [node]
+        while stack:
+            current = stack[-1]
+            if current in revs:
+                stack.pop()
+                continue
+
+            pl = parents(current)
+            unnumbered = [p for p in pl if p not in revs]
+            if unnumbered:
+                stack.extend(unnumbered)
+                continue
+
+            stack.pop()
+            revs[current] = len(self.nodes)
+            self.nodes.append(current)
+            self._parentrevs.append([revs[p] for p in pl])
+
+        return revs[node]
+
 class remotefilelog(object):
     def __init__(self, opener, path, repo):
         self.opener = opener
@@ -94,50 +253,53 @@ class remotefilelog(object):
         hashtext = _createrevlogtext(text, meta.get('copy'), meta.get('copyrev'))
         node = revlog.hash(hashtext, p1, p2)
 
-        def _createfileblob():
-            data = "%s\0%s" % (len(text), text)
-
-            realp1 = p1
-            copyfrom = ""
-            if 'copy' in meta:
-                copyfrom = meta['copy']
-                realp1 = bin(meta['copyrev'])
-
-            data += "%s%s%s%s%s\0" % (node, realp1, p2, linknode, copyfrom)
-
-            pancestors = {}
-            queue = []
-            if realp1 != nullid:
-                p1flog = self
-                if copyfrom:
-                    p1flog = remotefilelog(self.opener, copyfrom, self.repo)
-
-                pancestors.update(p1flog.ancestormap(realp1, relativeto=linknode))
-                queue.append(realp1)
-            if p2 != nullid:
-                pancestors.update(self.ancestormap(p2, relativeto=linknode))
-                queue.append(p2)
-
-            visited = set()
-            ancestortext = ""
-
-            # add the ancestors in topological order
-            while queue:
-                c = queue.pop(0)
-                visited.add(c)
-                pa1, pa2, ancestorlinknode, pacopyfrom = pancestors[c]
-
-                ancestortext += "%s%s%s%s%s\0" % (
-                    c, pa1, pa2, ancestorlinknode, pacopyfrom)
-
-                if pa1 != nullid and pa1 not in visited:
-                    queue.append(pa1)
-                if pa2 != nullid and pa2 not in visited:
-                    queue.append(pa2)
-
-            data += ancestortext
-
-            return data
+        realp1 = p1
+        copyfrom = ""
+        if 'copy' in meta:
+            copyfrom = meta['copy']
+            realp1 = bin(meta['copyrev'])
+
+        histories = []
+        if realp1 != nullid:
+            p1flog = self
+            if copyfrom:
+                p1flog = remotefilelog(self.opener, copyfrom, self.repo)
+            histories.append((realp1,) +
+                             p1flog._ancestorhistory(realp1, relativeto=linknode))
+        if p2 != nullid:
+            histories.append((p2,) +
+                             self._ancestorhistory(p2, relativeto=linknode))
+
+        def _writefileblob(f):
+            f.write("%s\0" % len(text))
+            f.write(text)
+            f.write("%s%s%s%s%s\0" % (node, realp1, p2, linknode, copyfrom))
+
+            written = set()
+            for pnode, mapping, history in histories:
+                if history is not None and not written:
+                    # The parent's own blob already serializes exactly these
+                    # records, so copy them instead of rebuilding them.
+                    f.write(history)
+                    written.update(mapping)
+                    continue
+
+                if pnode in written:
+                    continue
+                written.add(pnode)
+
+                # add the remaining ancestors in topological order
+                queue = collections.deque([pnode])
+                while queue:
+                    c = queue.popleft()
+                    pa1, pa2, ancestorlinknode, pacopyfrom = mapping[c]
+                    f.write("%s%s%s%s%s\0" % (
+                        c, pa1, pa2, ancestorlinknode, pacopyfrom))
+
+                    for pa in (pa1, pa2):
+                        if pa != nullid and pa not in written:
+                            written.add(pa)
+                            queue.append(pa)
 
         key = fileserverclient.getlocalkey(self.filename, hex(node))
         path = os.path.join(self.localpath, key)
@@ -147,12 +309,10 @@ class remotefilelog(object):
         oldumask = os.umask(0o002)
         try:
             if os.path.exists(path):
-                filename = os.path.basename(path)
-                directory = os.path.dirname(path)
-                files = [f for f in os.listdir(directory) if f.startswith(filename)]
-                shutil.copyfile(path, path + str(len(files)))
+                count = len(list(_alternates(path)))
+                shutil.copyfile(path, path + str(count + 1))
 
-            _writefile(path, _createfileblob())
+            _writefile(path, _writefileblob)
         finally:
             os.umask(oldumask)
 
@@ -265,6 +425,18 @@ class remotefilelog(object):
 
     def _read(self, id):
         """reads the raw file blob from disk, cache, or server"""
+        raw = self._readraw(id)
+        self._indexrenames(bin(id), raw)
+        return raw
+
+    def _indexrenames(self, node, raw):
+        """records the copy information in the history of a blob of node in
+        the rename index, wherever the blob came from, unless it's known"""
+        renameindex = self.repo.fileservice.renameindex
+        if renameindex.get(self.filename, node) is None:
+            renameindex.addblob(self.filename, raw)
+
+    def _readraw(self, id):
         fileservice = self.repo.fileservice
         localcache = fileservice.localcache
         cachekey = fileserverclient.getcachekey(self.repo.name, self.filename, id)
@@ -282,13 +454,20 @@ class remotefilelog(object):
 
         fileservice.prefetch([(self.filename, id)])
         try:
-            return localcache.read(cachekey)
+            raw = localcache.read(cachekey)
         except KeyError:
-            pass
+            raise error.LookupError(id, self.filename, _('no node'))
 
-        raise error.LookupError(id, self.filename, _('no node'))
+        if fileservice.accesslog:
+            fileservice.accesslog.miss(self.filename, id)
+        return raw
 
     def ancestormap(self, node, relativeto=None):
+        return self._ancestorhistory(node, relativeto)[0]
+
+    def _ancestorhistory(self, node, relativeto=None):
+        """returns the ancestormap of node, and the serialized history it was
+        read from, or None if the linknodes had to be adjusted"""
         # ancestormaps are a bit complex, and here's why:
         #
         # The key for filelog blobs contains the hash for the file path and for
@@ -306,15 +485,21 @@ class remotefilelog(object):
 
         localcache = self.repo.fileservice.localcache
         reponame = self.repo.name
+        cachekey = fileserverclient.getcachekey(reponame, self.filename, hexnode)
+        historykey = fileserverclient.gethistorykey(reponame, self.filename,
+                                                    hexnode)
         for i in range(0,2):
-            cachekey = fileserverclient.getcachekey(reponame, self.filename, hexnode)
-            try:
-                raw = localcache.read(cachekey)
-                mapping = self._ancestormap(node, raw, relativeto, fromserver=True)
-                if mapping:
-                    return mapping
-            except KeyError:
-                pass
+            # a history-only blob is as good as the full one here
+            for key in (cachekey, historykey):
+                try:
+                    raw = localcache.read(key)
+                    mapping = self._ancestormap(node, raw, relativeto,
+                                                fromserver=True)
+                    if mapping:
+                        self._indexrenames(node, raw)
+                        return mapping, self._history(raw)
+                except KeyError:
+                    pass
 
             localkey = fileserverclient.getlocalkey(self.filename, hexnode)
             localpath = os.path.join(self.localpath, localkey)
@@ -322,30 +507,21 @@ class remotefilelog(object):
                 raw = _readfile(localpath)
                 mapping = self._ancestormap(node, raw, relativeto)
                 if mapping:
-                    return mapping
+                    self._indexrenames(node, raw)
+                    return mapping, self._history(raw)
             except IOError:
                 pass
 
             # past versions may contain valid linknodes
-            try:
-                filename = os.path.basename(localpath)
-                directory = os.path.dirname(localpath)
-                alternates = [f for f in os.listdir(directory) if
-                         len(f) > 40 and f.startswith(filename)]
-                alternates = sorted(alternates, key=lambda x: int(x[40:]))
-
-                for alternate in alternates:
-                    alternatepath = os.path.join(directory, alternate)
-                    try:
-                        raw = _readfile(alternatepath)
-                        mapping = self._ancestormap(node, raw, relativeto)
-                        if mapping:
-                            return mapping
-                    except IOError:
-                        pass
-            except OSError:
-                # Directory doesn't exist. Oh well
-                pass
+            for alternatepath in _alternates(localpath):
+                try:
+                    raw = _readfile(alternatepath)
+                    mapping = self._ancestormap(node, raw, relativeto)
+                    if mapping:
+                        self._indexrenames(node, raw)
+                        return mapping, self._history(raw)
+                except IOError:
+                    pass
 
             # If exists locally, but with a bad history, adjust the linknodes
             # manually.
@@ -354,21 +530,29 @@ class remotefilelog(object):
                 mapping = self._ancestormap(node, raw, relativeto,
                     adjustlinknodes=True)
                 if mapping:
-                    return mapping
+                    return mapping, None
 
-            # Fallback to the server cache
-            self.repo.fileservice.prefetch([(self.filename, hexnode)],
+            # Fallback to the server, which only needs to send the history
+            self.repo.fileservice.prefetchhistory([(self.filename, hexnode)],
                 force=True)
-            try:
-                raw = localcache.read(cachekey)
-                mapping = self._ancestormap(node, raw, relativeto, fromserver=True)
-                if mapping:
-                    return mapping
-            except KeyError:
-                pass
+            for key in (cachekey, historykey):
+                try:
+                    raw = localcache.read(key)
+                    mapping = self._ancestormap(node, raw, relativeto,
+                                                fromserver=True)
+                    if mapping:
+                        self._indexrenames(node, raw)
+                        return mapping, self._history(raw)
+                except KeyError:
+                    pass
 
         raise error.LookupError(node, self.filename, _('no valid file history'))
 
+    def _history(self, raw):
+        """returns the ancestor records part of a blob"""
+        index, size = self._parsesize(raw)
+        return raw[index + 1 + size:]
+
     def _ancestormap(self, node, raw, relativeto, fromserver=False,
             adjustlinknodes=False):
         index, size = self._parsesize(raw)
@@ -389,8 +573,6 @@ class remotefilelog(object):
 
         # check that all linknodes are valid
         def validmap(node):
-            queue = [node]
-
             repo = self.repo
 
             # When writing new file revisions, we need a ancestormap
@@ -402,26 +584,29 @@ class remotefilelog(object):
                 if relativeto not in repo and relativeto in repo.unfiltered():
                     repo = repo.unfiltered()
 
+            isvalid, isancestor = _linknodecheckers(repo)
+
+            if relativeto:
                 p1, p2, linknode, copyfrom = mapping[node]
-                if not linknode in repo:
+                if not isvalid(linknode):
                     return False
 
-                cl = repo.changelog
-                common = cl.ancestor(linknode, relativeto)
-                if common != linknode:
+                if not isancestor(linknode, relativeto):
                     # Invalid key, unless it's from the server
                     return fromserver
 
-            # Also check that the linknodes actually exist.
-            while queue:
-                node = queue.pop(0)
+            # Also check that the linknodes actually exist. Merges make the
+            # history a DAG, so visit each node only once.
+            queue = [node]
+            seen = set(queue)
+            for node in queue:
                 p1, p2, linknode, copyfrom = mapping[node]
-                if not linknode in repo:
+                if not isvalid(linknode):
                     return False
-                if p1 != nullid:
-                    queue.append(p1)
-                if p2 != nullid:
-                    queue.append(p2)
+                for parent in (p1, p2):
+                    if parent != nullid and parent not in seen:
+                        seen.add(parent)
+                        queue.append(parent)
 
             return True
 
@@ -438,6 +623,8 @@ class remotefilelog(object):
         repo = self.repo
         cl = repo.unfiltered().changelog
         ma = repo.manifest
+        isvalid, isancestor = _linknodecheckers(repo.unfiltered())
+        pathindex = repo.pathindex
 
         newmapping = {}
 
@@ -452,14 +639,20 @@ class remotefilelog(object):
                 continue
 
             p1, p2, linknode, copyfrom = mapping[fnode]
-            if (autoaccept or (linknode in cl.nodemap and
-                cl.ancestor(linknode, source) == linknode)):
+            if (autoaccept or (isvalid(linknode) and
+                isancestor(linknode, source))):
                 newmapping[fnode] = p1, p2, linknode, copyfrom
                 stack.append((path, p2, linknode, True))
                 stack.append((copyfrom or path, p1, linknode, True))
             else:
                 srcrev = cl.rev(source)
                 iteranc = cl.ancestors([srcrev], inclusive=True)
+                touching = pathindex and pathindex.revs(path)
+                if touching is not None:
+                    # only visit the ancestors known to touch the path
+                    ancestors = iteranc
+                    touching = touching[:bisect.bisect_right(touching, srcrev)]
+                    iteranc = (a for a in reversed(touching) if a in ancestors)
                 for a in iteranc:
                     ac = cl.read(a) # get changeset data (we avoid object creation)
                     if path in ac[3]: # checking the 'files' field.
@@ -486,13 +679,14 @@ class remotefilelog(object):
         if a == nullid or b == nullid:
             return nullid
 
-        revmap, parentfunc = self._buildrevgraph(a, b)
-        nodemap = dict(((v,k) for (k,v) in revmap.iteritems()))
+        graph = self._revgraph()
+        arev = self._graphrev(graph, a)
+        brev = self._graphrev(graph, b)
 
-        ancs = ancestor.ancestors(parentfunc, revmap[a], revmap[b])
+        ancs = ancestor.ancestors(graph.parentrevs, arev, brev)
         if ancs:
             # choose a consistent winner when there's a tie
-            return min(map(nodemap.__getitem__, ancs))
+            return min(map(graph.nodes.__getitem__, ancs))
         return nullid
 
     def commonancestorsheads(self, a, b):
@@ -501,60 +695,32 @@ class remotefilelog(object):
         if a == nullid or b == nullid:
             return nullid
 
-        revmap, parentfunc = self._buildrevgraph(a, b)
-        nodemap = dict(((v,k) for (k,v) in revmap.iteritems()))
+        graph = self._revgraph()
+        arev = self._graphrev(graph, a)
+        brev = self._graphrev(graph, b)
 
-        ancs = ancestor.commonancestorsheads(parentfunc, revmap[a], revmap[b])
-        return map(nodemap.__getitem__, ancs)
+        ancs = ancestor.commonancestorsheads(graph.parentrevs, arev, brev)
+        return map(graph.nodes.__getitem__, ancs)
 
-    def _buildrevgraph(self, a, b):
-        """Builds a numeric revision graph for the given two nodes.
-        Returns a node->rev map and a rev->[revs] parent function.
+    def _revgraph(self):
+        """Returns the revgraph of this file, shared by all the remotefilelogs
+        of the repo for the same path, so merges touching many files don't
+        rebuild graphs for every ancestor query.
         """
-        amap = self.ancestormap(a)
-        bmap = self.ancestormap(b)
-
-        # Union the two maps
-        parentsmap = collections.defaultdict(list)
-        allparents = set()
-        for mapping in (amap, bmap):
-            for node, pdata in mapping.iteritems():
-                parents = parentsmap[node]
-                p1, p2, linknode, copyfrom = pdata
-                # Don't follow renames (copyfrom).
-                # remotefilectx.ancestor does that.
-                if p1 != nullid and not copyfrom:
-                    parents.append(p1)
-                    allparents.add(p1)
-                if p2 != nullid:
-                    parents.append(p2)
-                    allparents.add(p1)
-
-
-        # Breadth first traversal to build linkrev graph
-        parentrevs = collections.defaultdict(list)
-        revmap = {}
-        queue = collections.deque(((None, n) for n in parentsmap.iterkeys()
-                 if n not in allparents))
-        while queue:
-            prevrev, current = queue.pop()
-            if current in revmap:
-                if prevrev:
-                    parentrevs[prevrev].append(revmap[current])
-                continue
-
-            # Assign linkrevs in reverse order, so start at
-            # len(parentsmap) and work backwards.
-            currentrev = len(parentsmap) - len(revmap) - 1
-            revmap[current] = currentrev
-
-            if prevrev:
-                parentrevs[prevrev].append(currentrev)
-
-            for parent in parentsmap.get(current):
-                queue.appendleft((currentrev, parent))
-
-        return revmap, parentrevs.__getitem__
+        graphs = self.repo.unfiltered().__dict__.setdefault(
+            '_remotefilelogrevgraphs', {})
+        graph = graphs.get(self.filename)
+        if graph is None:
+            if len(graphs) >= 1000:
+                graphs.clear()
+            graph = graphs[self.filename] = revgraph()
+        return graph
+
+    def _graphrev(self, graph, node):
+        rev = graph.revs.get(node)
+        if rev is None:
+            rev = graph.add(node, self.ancestormap(node))
+        return rev
 
     def strip(self, minlink, transaction):
         pass
@@ -6,11 +6,12 @@
 # GNU General Public License version 2 or any later version.
 
 from mercurial import wireproto, changegroup, match, util, changelog, context
+from mercurial import error
 from mercurial.extensions import wrapfunction
 from mercurial.node import bin, hex, nullid, nullrev
 from mercurial.i18n import _
-import shallowrepo
-import stat, os, lz4, time
+import shallowrepo, shallowutil
+import stat, os, lz4, time, collections
 
 def setupserver(ui, repo):
     """Sets up a normal Mercurial repo so it can serve files to shallow repos.
@@ -55,6 +56,9 @@ def onetimesetup(ui):
     # support file content requests
     wireproto.commands['getfiles'] = (getfiles, '')
 
+    # support file history requests
+    wireproto.commands['gethistory'] = (gethistory, '')
+
     class streamstate(object):
         match = None
         shallowremote = False
@@ -143,6 +147,9 @@ def onetimesetup(ui):
         if (shallowrepo.requirement in repo.requirements or
             ui.configbool('remotefilelog', 'server')):
             caps += " " + shallowrepo.requirement
+        if (shallowrepo.requirement not in repo.requirements and
+            ui.configbool('remotefilelog', 'server')):
+            caps += " gethistory"
         return caps
     wrapfunction(wireproto, 'capabilities', capabilities)
 
@@ -157,9 +164,11 @@ def getfiles(repo, proto):
         fin = proto.fin
         opener = repo.sopener
 
-        cachepath = repo.ui.config("remotefilelog", "servercachepath")
-        if not cachepath:
-            cachepath = os.path.join(repo.path, "remotefilelogcache")
+        cachepath = getcachepath(repo)
+
+        # remember what was served so gc can expire blobs without walking
+        # the whole cache
+        served = []
 
         # everything should be user & group read/writable
         oldumask = os.umask(0o002)
@@ -178,12 +187,17 @@ def getfiles(repo, proto):
 
                 filecachepath = os.path.join(cachepath, path, hex(node))
                 if not os.path.exists(filecachepath):
-                    filectx = repo.filectx(path, fileid=node)
-                    if filectx.node() == nullid:
-                        repo.changelog = changelog.changelog(repo.sopener)
+                    try:
                         filectx = repo.filectx(path, fileid=node)
-
-                    text = createfileblob(filectx)
+                        if filectx.node() == nullid:
+                            repo.changelog = changelog.changelog(repo.sopener)
+                            filectx = repo.filectx(path, fileid=node)
+
+                        text = createfileblob(filectx)
+                    except error.LookupError:
+                        yield '%s\n' % shallowutil.missingreply
+                        proto.fout.flush()
+                        continue
                     text = lz4.compressHC(text)
 
                     dirname = os.path.dirname(filecachepath)
@@ -202,27 +216,95 @@ def getfiles(repo, proto):
 
                 yield '%d\n%s' % (len(text), text)
 
+                served.append(os.path.join(path, hex(node)))
+                if len(served) >= 1000:
+                    recordgcindex(repo, served)
+                    served = []
+
                 # it would be better to only flush after processing a whole batch
                 # but currently we don't know if there are more requests coming
                 proto.fout.flush()
         finally:
+            if served:
+                recordgcindex(repo, served)
             os.umask(oldumask)
 
     return wireproto.streamres(streamer())
 
 
+# gethistory only reads cached full blobs up to this size
+_historyreuselimit = 1024 * 1024
+
+def gethistory(repo, proto):
+    """A server api for requesting just the history of particular versions of
+    particular files, for clients that don't need their contents.
+
+    Requests are read and answered like getfiles, except that the blobs have
+    an empty content.
+    """
+    if shallowrepo.requirement in repo.requirements:
+        raise util.Abort(_('cannot fetch remote files from shallow repo'))
+
+    def streamer():
+        fin = proto.fin
+        cachepath = getcachepath(repo)
+
+        while True:
+            request = fin.readline()[:-1]
+            if not request:
+                break
+
+            node = bin(request[:40])
+            if node == nullid:
+                yield '0\n'
+                continue
+
+            path = request[40:]
+
+            # Reuse the full blob if it has already been generated, unless
+            # decompressing it would cost more than walking the history.
+            filecachepath = os.path.join(cachepath, path, hex(node))
+            text = None
+            try:
+                if os.path.getsize(filecachepath) <= _historyreuselimit:
+                    with open(filecachepath, "r") as f:
+                        text = lz4.decompress(f.read())
+                    index = text.index('\0')
+                    size = int(text[:index])
+                    text = "0\0" + text[index + 1 + size:]
+            except (IOError, OSError, ValueError):
+                text = None
+
+            if text is None:
+                try:
+                    filectx = repo.filectx(path, fileid=node)
+                    if filectx.node() == nullid:
+                        repo.changelog = changelog.changelog(repo.sopener)
+                        filectx = repo.filectx(path, fileid=node)
+                    text = createhistoryblob(filectx)
+                except error.LookupError:
+                    yield '%s\n' % shallowutil.missingreply
+                    proto.fout.flush()
+                    continue
+
+            text = lz4.compressHC(text)
+            yield '%d\n%s' % (len(text), text)
+            proto.fout.flush()
+
+    return wireproto.streamres(streamer())
+
+
 def incominghook(ui, repo, node, source, url, **kwargs):
     """Server hook that produces the shallow file blobs immediately after
     a commit, in anticipation of them being requested soon.
     """
-    cachepath = repo.ui.config("remotefilelog", "servercachepath")
-    if not cachepath:
-        cachepath = os.path.join(repo.path, "remotefilelogcache")
+    cachepath = getcachepath(repo)
 
     heads = repo.revs("heads(%s::)" % node)
 
     # everything should be user & group read/writable
     oldumask = os.umask(0o002)
+    created = []
     try:
         count = 0
         for head in heads:
@@ -251,12 +333,22 @@ def incominghook(ui, repo, node, source, url, **kwargs):
                     f.write(text)
                 finally:
                     f.close()
+                created.append(os.path.join(filename, hex(filenode)))
     finally:
+        if created:
+            recordgcindex(repo, created)
         os.umask(oldumask)
 
 
 def createfileblob(filectx):
     text = filectx.data()
+    return "%d\0%s%s" % (len(text), text, _ancestortext(filectx))
+
+def createhistoryblob(filectx):
+    """returns a blob with the history of filectx, but no content"""
+    return "0\0%s" % _ancestortext(filectx)
+
+def _ancestortext(filectx):
     repo = filectx._repo
 
     ancestors = [filectx]
@@ -286,39 +378,177 @@ def createfileblob(filectx):
     finally:
         repo.forcelinkrev = False
 
-    return "%d\0%s%s" % (len(text), text, ancestortext)
+    return ancestortext
+
+def getcachepath(repo):
+    cachepath = repo.ui.config("remotefilelog", "servercachepath")
+    if not cachepath:
+        cachepath = os.path.join(repo.path, "remotefilelogcache")
+    return cachepath
+
+# The gc index is an append-only log of "<time> <key>\n" lines, where key is
+# the blob path relative to the server cache. A key may appear many times; the
+# newest time wins. It lives in .hg instead of the cache so that it is never
+# mistaken for a blob.
+gcindexfile = "remotefilelogcache.gcindex"
+# An empty marker, created once the index has been seeded from the blobs that
+# predate it.
+gcstatefile = "remotefilelogcache.gcstate"
+
+def _isblobkey(key):
+    """Whether key names a blob, whose file name is a hex node. Anything
+    else in the cache isn't gc's business."""
+    node = os.path.basename(key)
+    if len(node) != 40:
+        return False
+    try:
+        bin(node)
+    except TypeError:
+        return False
+    return True
+
+def recordgcindex(repo, keys, when=None):
+    """Marks the given server cache keys as created or served at `when`."""
+    if when is None:
+        when = time.time()
+    when = int(when)
+    data = "".join("%d %s\n" % (when, key) for key in keys)
+    try:
+        with open(repo.join(gcindexfile), "a") as f:
+            f.write(data)
+    except IOError:
+        # Don't abort if the user only has permission to read the repo.
+        pass
+
+def _readgcindex(path, entries):
+    try:
+        f = open(path, "r")
+    except IOError:
+        return entries
+
+    with f:
+        for line in f:
+            try:
+                when, key = line[:-1].split(" ", 1)
+                when = int(when)
+            except ValueError:
+                # a partially written line from an interrupted server
+                continue
+            if not _isblobkey(key):
+                continue
+            if entries.get(key, -1) < when:
+                entries[key] = when
+    return entries
+
+def _seedgcindex(ui, repo, cachepath):
+    """Records every blob already in the cache, using its mtime. This is only
+    done the first time gc runs, for caches that predate the index."""
+    _seeding = _("indexing server cache")
+    keys = collections.defaultdict(list)
+    count = 0
+    for root, dirs, files in os.walk(cachepath):
+        for file in files:
+            filepath = os.path.join(root, file)
+            count += 1
+            ui.progress(_seeding, count, unit="files")
+            key = os.path.relpath(filepath, cachepath)
+            if not _isblobkey(key):
+                continue
+            try:
+                mtime = os.stat(filepath).st_mtime
+            except OSError:
+                continue
+            keys[int(mtime)].append(key)
+    ui.progress(_seeding, None)
+
+    for mtime, mtimekeys in keys.iteritems():
+        recordgcindex(repo, mtimekeys, when=mtime)
+
+def _neededkeys(repo, keys):
+    """Returns the subset of keys that some head still references.
+
+    Instead of materializing every (path, node) of every head, only the paths
+    of the given keys are looked up in each head manifest, so the cost is
+    proportional to the eviction batch rather than the size of the repo.
+    """
+    bypath = collections.defaultdict(set)
+    for key in keys:
+        path, hexnode = os.path.split(key)
+        bypath[path].add(bin(hexnode))
+
+    needed = set()
+    for head in repo.revs("heads(all())"):
+        mf = repo[head].manifest()
+        for path, nodes in bypath.iteritems():
+            fnode = mf.get(path)
+            if fnode in nodes:
+                needed.add(os.path.join(path, hex(fnode)))
+    return needed
 
 def gcserver(ui, repo):
+    """Removes expired blobs from the server cache.
+
+    The whole gc index is read, deduplicated and written back on each run,
+    so the cost is linear in the number of index entries, even when
+    servergcbatchsize bounds how many blobs are examined and removed.
+    """
     if not repo.ui.configbool("remotefilelog", "server"):
         return
 
-    neededfiles = set()
-    heads = repo.revs("heads(all())")
+    cachepath = getcachepath(repo)
+    indexpath = repo.join(gcindexfile)
+    statepath = repo.join(gcstatefile)
 
-    cachepath = repo.join("remotefilelogcache")
-    for head in heads:
-        mf = repo[head].manifest()
-        for filename, filenode in mf.iteritems():
-            filecachepath = os.path.join(cachepath, filename, hex(filenode))
-            neededfiles.add(filecachepath)
+    if not os.path.exists(statepath):
+        _seedgcindex(ui, repo, cachepath)
+
+    # Move the live index aside so concurrent servers keep appending to a
+    # fresh one while we work. Whatever we keep is appended back afterwards.
+    workpath = indexpath + ".gc"
+    entries = _readgcindex(workpath, {})
+    if os.path.exists(indexpath):
+        os.rename(indexpath, workpath)
+        entries = _readgcindex(workpath, entries)
 
     # delete unneeded older files
     days = repo.ui.configint("remotefilelog", "serverexpiration", 30)
     expiration = time.time() - (days * 24 * 60 * 60)
+    batchsize = repo.ui.configint("remotefilelog", "servergcbatchsize", 0)
+
+    candidates = sorted((when, key) for key, when in entries.iteritems()
+                        if when < expiration)
+    if batchsize > 0:
+        candidates = candidates[:batchsize]
+    needed = _neededkeys(repo, [key for when, key in candidates])
 
     _removing = _("removing old server cache")
+    now = int(time.time())
     count = 0
-    ui.progress(_removing, count, unit="files")
-    for root, dirs, files in os.walk(cachepath):
-        for file in files:
-            filepath = os.path.join(root, file)
-            count += 1
-            ui.progress(_removing, count, unit="files")
-            if filepath in neededfiles:
-                continue
+    ui.progress(_removing, count, unit="files", total=len(candidates))
+    for when, key in candidates:
+        count += 1
+        ui.progress(_removing, count, unit="files", total=len(candidates))
+        if key in needed:
+            # Still referenced by a head, so don't look at it again until
+            # another expiration period has passed.
+            entries[key] = now
+            continue
 
-            stat = os.stat(filepath)
-            if stat.st_mtime < expiration:
-                os.remove(filepath)
+        try:
+            os.remove(os.path.join(cachepath, key))
+        except OSError:
+            pass
+        del entries[key]
 
     ui.progress(_removing, None)
+
+    bytime = collections.defaultdict(list)
+    for key, when in entries.iteritems():
+        bytime[when].append(key)
+    for when, keys in bytime.iteritems():
+        recordgcindex(repo, keys, when=when)
+    if os.path.exists(workpath):
+        os.remove(workpath)
+
+    if not os.path.exists(statepath):
+        open(statepath, "w").close()
@@ -0,0 +1,145 @@
+# renameindex.py - remembers which file versions are copies
+#
+# Copyright 2016 Facebook, Inc.
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+from mercurial.node import nullid
+from mercurial import util
+import errno, os
+
+# The index lives in .hg/renameindex, with a file per path named after the
+# hash of the path. Each file holds "<node><copyrev><copyfrom>\0<check>"
+# records, where copyrev is nullid and copyfrom empty for versions that aren't
+# copies, and check is the first 4 bytes of the sha1 of the rest of the
+# record. Whether a file version is a copy never changes, so records are never
+# invalidated. The check catches a record cut short by a crash and followed by
+# later appends; the file is rewritten from the records before it.
+indexdir = 'renameindex'
+checksize = 4
+
+def _record(node, copyrev, copyfrom):
+    data = "%s%s%s" % (node, copyrev, copyfrom)
+    return "%s\0%s" % (data, util.sha1(data).digest()[:checksize])
+
+class renameindex(object):
+    """A persistent index from (path, filenode) to the copy source of that
+    file version, filled from the history of every blob that is fetched, so
+    rename lookups don't need to read ancestormaps."""
+    def __init__(self, repo):
+        self.path = repo.vfs.join(indexdir)
+        self._entries = {}
+        self._pending = {}
+        # paths whose file has a damaged record, and must be rewritten
+        self._damaged = set()
+
+    def _pathfile(self, path):
+        pathhash = util.sha1(path).hexdigest()
+        return os.path.join(self.path, pathhash[:2], pathhash[2:])
+
+    def _load(self, path):
+        entries = self._entries.get(path)
+        if entries is None:
+            entries = self._entries[path] = {}
+            try:
+                with open(self._pathfile(path), 'rb') as f:
+                    data = f.read()
+            except IOError:
+                data = ''
+
+            start = 0
+            while start < len(data):
+                try:
+                    divider = data.index('\0', start + 40)
+                except ValueError:
+                    divider = len(data)
+                end = divider + 1 + checksize
+                check = data[divider + 1:end]
+                if (end > len(data) or
+                    util.sha1(data[start:divider]).digest()[:checksize] !=
+                    check):
+                    # a record that was being written when we crashed
+                    self._damaged.add(path)
+                    break
+                node = data[start:start + 20]
+                copyrev = data[start + 20:start + 40]
+                copyfrom = data[start + 40:divider]
+                entries[node] = (copyfrom, copyrev) if copyfrom else False
+                start = end
+        return entries
+
+    def get(self, path, node):
+        """returns the (copyfrom, copyrev) of the given file version, False
+        if it isn't a copy, or None if it isn't known"""
+        return self._load(path).get(node)
+
+    def addblob(self, path, raw):
+        """records the copy information of every version in the history of
+        the given blob of path"""
+        index = raw.index('\0')
+        size = int(raw[:index])
+        start = index + 1 + size
+
+        # Records come children first, so the path of a version is known by
+        # the time its record is reached.
+        paths = {}
+        first = True
+        while start < len(raw):
+            divider = raw.index('\0', start + 80)
+            node = raw[start:start + 20]
+            p1 = raw[start + 20:start + 40]
+            p2 = raw[start + 40:start + 60]
+            copyfrom = raw[start + 80:divider]
+            start = divider + 1
+
+            if first:
+                nodepath = path
+                first = False
+            else:
+                nodepath = paths.get(node)
+                if nodepath is None:
+                    continue
+
+            if p1 != nullid:
+                paths.setdefault(p1, copyfrom or nodepath)
+            if p2 != nullid:
+                paths.setdefault(p2, nodepath)
+
+            if node in self._load(nodepath):
+                continue
+            if copyfrom:
+                value = (copyfrom, p1)
+            else:
+                value = False
+            self._entries[nodepath][node] = value
+            self._pending.setdefault(nodepath, []).append(
+                _record(node, p1 if copyfrom else nullid, copyfrom))
+
+    def flush(self):
+        """writes the records added since the last flush"""
+        pending = self._pending
+        self._pending = {}
+        for path, records in pending.iteritems():
+            pathfile = self._pathfile(path)
+            mode = 'ab'
+            if path in self._damaged:
+                # drop the damaged tail along with everything after it
+                self._damaged.discard(path)
+                mode = 'wb'
+                records = [_record(node, value[1] if value else nullid,
+                                   value[0] if value else '')
+                           for node, value in self._entries[path].iteritems()]
+            try:
+                try:
+                    f = open(pathfile, mode)
+                except IOError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                    os.makedirs(os.path.dirname(pathfile))
+                    f = open(pathfile, mode)
+                with f:
+                    f.write(''.join(records))
+            except (IOError, OSError):
+                # the index is only an optimization
+                pass
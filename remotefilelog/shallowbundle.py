@@ -6,7 +6,7 @@
 # GNU General Public License version 2 or any later version.
 
 import fileserverclient, remotefilelog, shallowutil
-import collections, os
+import collections, os, struct
 from mercurial.node import bin, hex, nullid, nullrev
 from mercurial import changegroup, revlog, phases, mdiff, match, bundlerepo
 from mercurial import util
@@ -23,36 +23,68 @@ def sortnodes(nodes, parentfunc):
     the parents of nodes."""
     nodes = set(nodes)
     childmap = {}
-    parentmap = {}
-    roots = []
+    parentcount = {}
+    roots = collections.deque()
 
-    # Build a child and parent map
+    # Build a child map and count each node's unprocessed parents
     for n in nodes:
-        parents = [p for p in parentfunc(n) if p in nodes]
-        parentmap[n] = set(parents)
+        parents = set(p for p in parentfunc(n) if p in nodes)
+        parentcount[n] = len(parents)
         for p in parents:
-            childmap.setdefault(p, set()).add(n)
+            childmap.setdefault(p, []).append(n)
         if not parents:
             roots.append(n)
 
     # Process roots, adding children to the queue as they become roots
     results = []
     while roots:
-        n = roots.pop(0)
+        n = roots.popleft()
         results.append(n)
-        if n in childmap:
-            children = childmap[n]
-            for c in children:
-                childparents = parentmap[c]
-                childparents.remove(n)
-                if len(childparents) == 0:
-                    # insert at the beginning, that way child nodes
-                    # are likely to be output immediately after their
-                    # parents.  This gives better compression results.
-                    roots.insert(0, c)
+        for c in childmap.get(n, ()):
+            parentcount[c] -= 1
+            if parentcount[c] == 0:
+                # insert at the beginning, that way child nodes
+                # are likely to be output immediately after their
+                # parents.  This gives better compression results.
+                roots.appendleft(c)
 
     return results
 
+class textcache(object):
+    """A least recently used cache of revision texts, bounded by the total
+    size of the texts it holds rather than by their count."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        text = self._entries.pop(key, None)
+        if text is not None:
+            self._entries[key] = text
+        return text
+
+    def set(self, key, text):
+        if len(text) > self.maxsize:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = text
+        self.size += len(text)
+        while self.size > self.maxsize:
+            oldkey, old = self._entries.popitem(last=False)
+            self.size -= len(old)
+
+def _localnodes(repo, fname):
+    """Returns the hex nodes of the local (non-cache) blobs of fname."""
+    localkey = fileserverclient.getlocalkey(fname, '')
+    try:
+        names = os.listdir(repo.sjoin(os.path.join("data", localkey)))
+    except OSError:
+        return set()
+    return set(name for name in names if len(name) == 40)
+
 def shallowgroup(cls, self, nodelist, rlog, lookup, units=None, reorder=None):
     if isinstance(rlog, revlog.revlog):
         for c in super(cls, self).group(nodelist, rlog, lookup,
@@ -109,43 +141,62 @@ class shallowcg1packer(changegroup.cg1packer):
             if filestosend == NoFiles:
                 changedfiles = list([f for f in changedfiles if not repo.shallowmatch(f)])
             else:
-                files = []
-                # Prefetch the revisions being bundled
-                for i, fname in enumerate(sorted(changedfiles)):
-                    filerevlog = repo.file(fname)
-                    linkrevnodes = linknodes(filerevlog, fname)
-                    # Normally we'd prune the linkrevnodes first,
-                    # but that would perform the server fetches one by one.
-                    for fnode, cnode in list(linkrevnodes.iteritems()):
-                        # Adjust linknodes so remote file revisions aren't sent
-                        if filestosend == LocalFiles:
-                            localkey = fileserverclient.getlocalkey(fname, hex(fnode))
-                            localpath = repo.sjoin(os.path.join("data", localkey))
-                            if not os.path.exists(localpath) and repo.shallowmatch(fname):
-                                del linkrevnodes[fnode]
-                            else:
-                                files.append((fname, hex(fnode)))
-                        else:
-                            files.append((fname, hex(fnode)))
-
-                repo.fileservice.prefetch(files)
-
-                # Prefetch the revisions that are going to be diffed against
-                prevfiles = []
-                for fname, fnode in files:
-                    if repo.shallowmatch(fname):
-                        fnode = bin(fnode)
-                        filerevlog = repo.file(fname)
-                        ancestormap = filerevlog.ancestormap(fnode)
-                        p1, p2, linknode, copyfrom = ancestormap[fnode]
-                        if p1 != nullid:
-                            prevfiles.append((copyfrom or fname, hex(p1)))
-
-                repo.fileservice.prefetch(prevfiles)
+                self._prefetchfiles(changedfiles, linknodes, filestosend)
 
         return super(shallowcg1packer, self).generatefiles(changedfiles,
                      linknodes, commonrevs, source)
 
+    def _prefetchfiles(self, changedfiles, linknodes, filestosend):
+        """Fetches the file revisions being bundled, and the revisions they
+        will be diffed against, in as few batches as possible."""
+        repo = self._repo
+
+        files = []
+        for fname in sorted(changedfiles):
+            filerevlog = repo.file(fname)
+            linkrevnodes = linknodes(filerevlog, fname)
+            if filestosend == LocalFiles and repo.shallowmatch(fname):
+                # Adjust linknodes so remote file revisions aren't sent. One
+                # listing of the file's local directory replaces a stat per
+                # revision.
+                localnodes = _localnodes(repo, fname)
+                for fnode in list(linkrevnodes):
+                    if hex(fnode) not in localnodes:
+                        del linkrevnodes[fnode]
+
+            files.extend((fname, fnode) for fnode in linkrevnodes)
+
+        shallowfiles = [(f, n) for f, n in files if repo.shallowmatch(f)]
+        bundled = set(shallowfiles)
+        missing = set(repo.fileservice.missing(
+            [(f, hex(n)) for f, n in shallowfiles]))
+
+        # The history of revisions that are already local tells us their
+        # delta bases right away, so those bases can be fetched together with
+        # the bundled revisions that aren't local yet.
+        local = [(f, n) for f, n in shallowfiles if (f, hex(n)) not in missing]
+        remote = [(f, n) for f, n in shallowfiles if (f, hex(n)) in missing]
+
+        def deltabases(fileids):
+            bases = []
+            maps = remotefilelog.ancestormaps(repo, fileids)
+            for (fname, fnode), ancestormap in maps.iteritems():
+                p1, p2, linknode, copyfrom = ancestormap[fnode]
+                base = (copyfrom or fname, p1)
+                # bases that are being bundled are fetched anyway
+                if p1 != nullid and base not in bundled:
+                    bases.append((base[0], hex(base[1])))
+            return bases
+
+        fetch = deltabases(local)
+        fetch.extend((f, hex(n)) for f, n in remote)
+        repo.fileservice.prefetch(fetch)
+
+        # Only revisions that weren't local need a second round trip for
+        # their bases.
+        if remote:
+            repo.fileservice.prefetch(deltabases(remote))
+
     def shouldaddfilegroups(self, source):
         repo = self._repo
         if not requirement in repo.requirements:
@@ -180,19 +231,43 @@ class shallowcg1packer(changegroup.cg1packer):
 
     def nodechunk(self, revlog, node, prev, linknode):
         prefix = ''
+        base = prev
         if prev == nullrev:
             delta = revlog.revision(node)
             prefix = mdiff.trivialdiffheader(len(delta))
         else:
-            delta = revlog.revdiff(prev, node)
+            text = revlog.revision(node)
+            if self._usefulltext(text):
+                if getattr(self, 'version', '01') != '01':
+                    # The delta base is explicit, so send the full text
+                    # without reading prev at all.
+                    base = nullid
+                    prefix = mdiff.trivialdiffheader(len(text))
+                else:
+                    # Replace all of prev instead of diffing against it.
+                    prevlen = len(revlog.revision(prev))
+                    prefix = struct.pack(">lll", 0, prevlen, len(text))
+                delta = text
+            else:
+                delta = mdiff.textdiff(revlog.revision(prev), text)
         p1, p2 = revlog.parents(node)
-        meta = self.builddeltaheader(node, p1, p2, prev, linknode)
+        meta = self.builddeltaheader(node, p1, p2, base, linknode)
         meta += prefix
         l = len(meta) + len(delta)
         yield changegroup.chunkheader(l)
         yield meta
         yield delta
 
+    def _usefulltext(self, text):
+        """Returns True if text should be sent whole instead of as a delta.
+
+        Diffing binary content rarely produces a useful delta, and diffing
+        very large texts costs more CPU than the bandwidth it saves.
+        """
+        threshold = self._repo.ui.configbytes("remotefilelog",
+                                              "fulltextthreshold", "10 MB")
+        return len(text) >= threshold or util.binary(text)
+
 if util.safehasattr(changegroup, 'cg2packer'):
     # Mercurial >= 3.3
     @shallowutil.interposeclass(changegroup, 'cg2packer')
@@ -283,66 +358,85 @@ def addchangegroupfiles(orig, repo, source, revmap, trp, pr, needfiles):
         if chain == None:
             raise util.Abort(_("received file revlog group is empty"))
 
-    processed = set()
-    def available(f, node, depf, depnode):
-        if depnode != nullid and (depf, depnode) not in processed:
-            if not (depf, depnode) in revisiondatas:
-                # It's not in the changegroup, assume it's already
-                # in the repo
-                return True
-            # re-add self to queue
-            queue.insert(0, (f, node))
-            # add dependency in front
-            queue.insert(0, (depf, depnode))
-            return False
-        return True
-
-    skipcount = 0
-
-    # Apply the revisions in topological order such that a revision
-    # is only written once it's deltabase and parents have been written.
-    while queue:
-        f, node = queue.pop(0)
-        if (f, node) in processed:
+    # Build the dependency graph between the received revisions. A revision
+    # can only be written once its deltabase and parents have been written.
+    # Dependencies outside the changegroup are assumed to already be in the
+    # repo.
+    dependents = collections.defaultdict(list)
+    pendingcount = {}
+    ready = collections.deque()
+    for key in queue:
+        if key in pendingcount:
             continue
+        f, node = key
+        revisiondata = revisiondatas[key]
+        deps = set()
+        for dep in (revisiondata['deltabase'], revisiondata['p1'],
+                    revisiondata['p2']):
+            if dep != nullid and (f, dep) in revisiondatas:
+                deps.add((f, dep))
+
+        pendingcount[key] = len(deps)
+        for dep in deps:
+            dependents[dep].append(key)
+        if not deps:
+            ready.append(key)
 
-        skipcount += 1
-        if skipcount > len(queue) + 1:
-            raise util.Abort(_("circular node dependency"))
+    processed = set()
+    # texts of copies whose copy source hasn't been written yet
+    waitingcopies = {}
+    # Recently built texts, so a delta chain within the changegroup doesn't
+    # read each freshly written base back from disk.
+    cachesize = repo.ui.configbytes("remotefilelog", "changegroupcachesize",
+                                    "100 MB")
+    texts = textcache(cachesize)
 
+    # Apply the revisions in topological order such that a revision
+    # is only written once it's deltabase, parents and copy source have been
+    # written.
+    while ready:
+        key = ready.popleft()
+        f, node = key
         fl = repo.file(f)
 
-        revisiondata = revisiondatas[(f, node)]
+        revisiondata = revisiondatas[key]
         p1 = revisiondata['p1']
         p2 = revisiondata['p2']
         linknode = revisiondata['cs']
-        deltabase = revisiondata['deltabase']
-        delta = revisiondata['delta']
 
-        if not available(f, node, f, deltabase):
-            continue
-
-        base = fl.revision(deltabase)
-        text = mdiff.patch(base, delta)
-        if isinstance(text, buffer):
-            text = str(text)
-
-        meta, text = remotefilelog._parsemeta(text)
-        if 'copy' in meta:
-            copyfrom = meta['copy']
-            copynode = bin(meta['copyrev'])
-            copyfl = repo.file(copyfrom)
-            if not available(f, node, copyfrom, copynode):
-                continue
-
-        for p in [p1, p2]:
-            if p != nullid:
-                if not available(f, node, f, p):
+        if key in waitingcopies:
+            meta, text = waitingcopies.pop(key)
+        else:
+            deltabase = revisiondata['deltabase']
+            base = texts.get((f, deltabase))
+            if base is None:
+                base = fl.revision(deltabase)
+            text = mdiff.patch(base, revisiondata['delta'])
+            if isinstance(text, buffer):
+                text = str(text)
+            texts.set(key, text)
+
+            meta, text = remotefilelog._parsemeta(text)
+            if 'copy' in meta:
+                # The copy source is only known once the text is built, so
+                # add that edge to the graph now.
+                copykey = (meta['copy'], bin(meta['copyrev']))
+                if copykey in revisiondatas and copykey not in processed:
+                    waitingcopies[key] = (meta, text)
+                    pendingcount[key] = 1
+                    dependents[copykey].append(key)
                     continue
 
         fl.add(text, meta, trp, linknode, p1, p2)
-        processed.add((f, node))
-        skipcount = 0
+        processed.add(key)
+
+        for child in dependents.pop(key, ()):
+            pendingcount[child] -= 1
+            if pendingcount[child] == 0:
+                ready.append(child)
+
+    if len(processed) != len(revisiondatas):
+        raise util.Abort(_("circular node dependency"))
 
     repo.ui.progress(_('files'), None)
 
@@ -7,12 +7,30 @@
 
 from mercurial.node import hex, nullid, nullrev, bin
 from mercurial.i18n import _
-from mercurial import localrepo, context, util, match, scmutil
+from mercurial import localrepo, context, error, util, match, scmutil
 from mercurial.extensions import wrapfunction
 import remotefilelog, remotefilectx, fileserverclient, shallowbundle, os
+import pathindex, prefetchqueue
 
 requirement = "remotefilelog"
 
+def _basediff(basemf, entries):
+    """yields the (path, node) entries that differ from the base manifest"""
+    for path, fnode in entries:
+        if basemf.get(path) != fnode:
+            yield path, fnode
+
+def _manifestdiff(basemf, mfdict):
+    """yields the (path, node) entries of mfdict that differ from basemf"""
+    if basemf and util.safehasattr(basemf, 'diff'):
+        # let the manifest implementation compute the difference
+        for path, ((n1, fl1), (n2, fl2)) in basemf.diff(mfdict).iteritems():
+            if n2 is not None and n2 != n1:
+                yield path, n2
+    else:
+        for entry in _basediff(basemf, mfdict.iteritems()):
+            yield entry
+
 def wraprepo(repo):
     class shallowrepository(repo.__class__):
         @util.propertycache
@@ -26,6 +44,14 @@ def wraprepo(repo):
                      repo.ui.config("remotefilelog", "fallbackrepo",
                        repo.ui.config("paths", "default")))
 
+        @util.propertycache
+        def pathindex(self):
+            """the index of changesets per path, or None if it is disabled
+            with remotefilelog.pathindex"""
+            if pathindex.enabled(self):
+                return pathindex.pathindex(self)
+            return None
+
         def sparsematch(self, *revs):
             baseinstance = super(shallowrepository, self)
             if util.safehasattr(baseinstance, 'sparsematch'):
@@ -62,20 +88,44 @@ def wraprepo(repo):
                 if fparent1 != nullid:
                     files.append((f, hex(fparent1)))
             self.fileservice.prefetch(files)
-            return super(shallowrepository, self).commitctx(ctx, error=error)
+            node = super(shallowrepository, self).commitctx(ctx, error=error)
+            if self.pathindex:
+                self.pathindex.update()
+            return node
+
+        def _localrevs(self):
+            """Returns the set of revs that may not be on the server yet.
 
-        def prefetch(self, revs, base=None, pats=None, opts=None):
+            Public commits are assumed to be on the server, so this comes from
+            phases rather than from discovery against the fallbackpath. The
+            result is reused until the changelog or the phases change.
+            """
+            cl = repo.changelog
+            phaseroots = tuple(frozenset(roots)
+                               for roots in repo._phasecache.phaseroots)
+            key = (len(cl), cl.tip(), phaseroots)
+            cached = getattr(self, '_localrevscache', None)
+            if cached is None or cached[0] != key:
+                cached = (key, set(repo.revs('not public()')))
+                self._localrevscache = cached
+            return cached[1]
+
+        def prefetch(self, revs, base=None, pats=None, opts=None,
+                     background=False):
             """Prefetches all the necessary file revisions for the given revs
+
+            The file revisions are queued first, so an interrupted prefetch
+            resumes the next time one runs. If background is True, they are
+            fetched by a detached, low priority process instead.
             """
             fallbackpath = self.fallbackpath
             if fallbackpath:
                 # If we know a rev is on the server, we should fetch the server
                 # version of those files, since our local file versions might
                 # become obsolete if the local commits are stripped.
-                localrevs = repo.revs('outgoing(%s)', fallbackpath)
+                localrevs = self._localrevs()
                 if base is not None and base != nullrev:
-                    serverbase = list(repo.revs('first(reverse(::%s) - %ld)', base,
-                                     localrevs))
+                    serverbase = list(repo.revs('max(::%d & public())', base))
                     if serverbase:
                         base = serverbase[0]
             else:
@@ -83,15 +133,15 @@ def wraprepo(repo):
 
             mf = repo.manifest
             if base is not None:
-                mfdict = mf.read(repo[base].manifestnode())
-                skip = set(mfdict.iteritems())
+                basemf = mf.read(repo[base].manifestnode())
             else:
-                skip = set()
+                basemf = {}
 
-            # Copy the skip set to start large and avoid constant resizing,
-            # and since it's likely to be very similar to the prefetch set.
-            files = skip.copy()
-            serverfiles = skip.copy()
+            # Only (path, node) pairs that differ from the base manifest are
+            # collected, so memory is proportional to the diffs rather than
+            # to the size of the tree.
+            files = set()
+            serverfiles = set()
             visited = set()
             visited.add(nullrev)
             for rev in sorted(revs):
@@ -104,14 +154,14 @@ def wraprepo(repo):
                 mfrev = mf.rev(mfnode)
 
                 # Decompressing manifests is expensive.
-                # When possible, only read the deltas.
+                # When possible, only read the deltas. Anything not in the
+                # delta matches a parent we already visited.
                 p1, p2 = mf.parentrevs(mfrev)
                 if p1 in visited and p2 in visited:
-                    mfdict = mf.readfast(mfnode)
+                    diff = _basediff(basemf, mf.readfast(mfnode).iteritems())
                 else:
-                    mfdict = mf.read(mfnode)
+                    diff = _manifestdiff(basemf, mf.read(mfnode))
 
-                diff = mfdict.iteritems()
                 if pats:
                     diff = (pf for pf in diff if m(pf[0]))
                 if sparsematch:
@@ -123,18 +173,19 @@ def wraprepo(repo):
 
                 visited.add(mfrev)
 
-            files.difference_update(skip)
-            serverfiles.difference_update(skip)
-
-            # Fetch files known to be on the server
-            if serverfiles:
-                results = [(path, hex(fnode)) for (path, fnode) in serverfiles]
-                repo.fileservice.prefetch(results, force=True)
-
-            # Fetch files that may or may not be on the server
-            if files:
-                results = [(path, hex(fnode)) for (path, fnode) in files]
-                repo.fileservice.prefetch(results)
+            try:
+                prefetchqueue.enqueue(repo, serverfiles, files)
+            except (IOError, OSError, error.LockError):
+                # .hg isn't writable, so the queue can't be used
+                prefetchqueue.fetch(repo,
+                    [(path, hex(node)) for path, node in serverfiles],
+                    [(path, hex(node)) for path, node in files])
+                return
+
+            if background:
+                prefetchqueue.runbackground(repo)
+            else:
+                prefetchqueue.run(repo)
 
     # Wrap dirstate.status here so we can prefetch all file nodes in
     # the lookup set before localrepo.status uses them.
@@ -5,6 +5,35 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2 or any later version.
 
+import errno, os
+
+# Sent by getfiles and gethistory in place of the size line of a version the
+# server doesn't have, so the client can tell that apart from a failure.
+missingreply = 'missing'
+
+def makedirs(root, path, owner):
+    """Creates path and its missing parents below root, making the ones
+    owned by owner group writable and setgid, so processes of other users
+    sharing the cache can use them."""
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+
+    while path != root:
+        stat = os.stat(path)
+        if stat.st_uid == owner:
+            os.chmod(path, 0o2775)
+        path = os.path.dirname(path)
+
+def unlinkifexists(path):
+    try:
+        os.unlink(path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
 def interposeclass(container, classname):
     '''Interpose a class into the hierarchies of all loaded subclasses. This
     function is intended for use as a decorator.
@@ -28,3 +28,58 @@ Test blame
   1: y
   2: z
   2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+
+Test streaming blame
+
+  $ cd ..
+  $ hgcloneshallow ssh://user@dummy/master shallow2 -q
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow2
+  $ hg blame x --config remotefilelog.streamingannotate=True
+  0: x
+  1: y
+  2: z
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+
+Streaming blame doesn't fetch revisions older than the last one to rewrite
+every line
+
+  $ cd ..
+  $ hginit master2
+  $ cd master2
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > EOF
+  $ printf 'a\nb\nc\n' > f
+  $ hg commit -qAm 0
+  $ printf 'a\nb\nC\n' > f
+  $ hg commit -qm 1
+  $ printf 'a\nB\nC\n' > f
+  $ hg commit -qm 2
+  $ printf '1\n2\n3\n' > f
+  $ hg commit -qm 3
+  $ printf '1\n2\nthree\n' > f
+  $ hg commit -qm 4
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master2 shallow3 -q
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow3
+  $ hg blame f
+  3: 1
+  3: 2
+  4: three
+  4 files fetched over 1 fetches - (4 misses, 0.00% hit ratio) over *s (glob)
+
+  $ cd ..
+  $ clearcache
+  $ hgcloneshallow ssh://user@dummy/master2 shallow4 -q
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow4
+  $ hg blame f --config remotefilelog.streamingannotate=True \
+  >   --config remotefilelog.annotatebatchsize=1
+  3: 1
+  3: 2
+  4: three
+  2 files fetched over 2 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
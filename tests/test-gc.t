@@ -46,3 +46,18 @@
   finished: removed 0 of 1 files (0.00 GB to 0.00 GB)
   $ find master/.hg/remotefilelogcache -type f | wc -l
   1
+
+# server gc only keeps index entries for blobs that still exist
+
+  $ cat master/.hg/remotefilelogcache.gcindex | wc -l
+  1
+
+# server gc ignores files in the cache that aren't blobs
+
+  $ touch master/.hg/remotefilelogcache/stray
+  $ echo "0 stray" >> master/.hg/remotefilelogcache.gcindex
+  $ hg gc master > /dev/null
+  $ ls master/.hg/remotefilelogcache/stray
+  master/.hg/remotefilelogcache/stray
+  $ cat master/.hg/remotefilelogcache.gcindex | wc -l
+  1
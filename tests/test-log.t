@@ -87,3 +87,40 @@ Log on a file from inside a directory
   date:        Thu Jan 01 00:00:00 1970 +0000
   summary:     y
   
+
+Log on a file without -f, using the path index
+
+  $ cd ..
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > pathindex=True
+  > EOF
+  $ hg log dir/y
+  changeset:   1:2e73264fab97
+  tag:         tip
+  user:        test
+  date:        Thu Jan 01 00:00:00 1970 +0000
+  summary:     y
+  
+  $ hg log -r 'filelog(x)' -T '{rev}\n'
+  0
+  $ ls .hg/pathindex
+  11
+  f6
+  nodes
+
+Log -f on a fresh clone only fetches the history of the file
+
+  $ cd ..
+  $ hgcloneshallow ssh://user@dummy/master shallow2 --noupdate -q
+  $ cd shallow2
+  $ hg update -q
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ clearcache
+  $ hg log -f x -T '{rev}\n'
+  0
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ find $CACHEDIR -name '*.history' | wc -l | sed 's/ //g'
+  1
+  $ hg log -f x -T '{rev}\n'
+  0
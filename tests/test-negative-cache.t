@@ -0,0 +1,43 @@
+  $ . "$TESTDIR/library.sh"
+
+  $ hginit master
+  $ cd master
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > server=True
+  > EOF
+  $ echo x > x
+  $ hg commit -qAm x
+  $ cd ..
+
+  $ hgcloneshallow ssh://user@dummy/master shallow -q
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ cd shallow
+  $ cat >> .hg/hgrc <<EOF
+  > [remotefilelog]
+  > negativecacheondisk=True
+  > EOF
+
+# A local version that the server doesn't have, and that is lost locally
+
+  $ echo y > x
+  $ hg commit -qm y
+  $ rm -rf .hg/store/data
+
+The first lookup asks the server
+
+  $ hg cat -r 1 x 2>&1 | egrep 'fetched|abort'
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  abort: x@*: unable to download 1 files! (glob)
+
+The second one fails without contacting it
+
+  $ hg cat -r 1 x 2>&1 | egrep 'fetched|abort'
+  abort: x@*: unable to download 1 files! (glob)
+  $ ls $CACHEDIR/.missing | wc -l
+  1
+
+Versions the server has are still fetched
+
+  $ hg cat -r 0 x
+  x
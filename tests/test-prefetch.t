@@ -127,3 +127,90 @@
   (run 'hg update' to get a working copy)
   prefetching file contents
   2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+
+# prefetch in the background, with the output going to .hg/prefetch.log
+
+  $ cd ..
+  $ hgcloneshallow ssh://user@dummy/master shallow2 --noupdate -q
+  $ cd shallow2
+  $ clearcache
+  $ hg prefetch -r 1 --background
+  $ while [ ! -s .hg/prefetch.log ]; do sleep 0.1; done
+  $ cat .hg/prefetch.log
+  3 files fetched over 1 fetches - (3 misses, 0.00% hit ratio) over *s (glob)
+  $ test -e .hg/prefetchqueue
+  [1]
+  $ hg cat -r 1 x
+  x2
+  $ rm .hg/prefetch.log
+
+# resume an interrupted prefetch from the recorded progress; x was already
+# fetched, so only the rest of the queue and the newly added y are fetched
+
+  $ clearcache
+  $ hg manifest --debug -r 1 | awk '$NF != "y" {print "s", $1, $NF}' > .hg/prefetchqueue
+  $ cat .hg/prefetchqueue
+  s ef95c5376f34698742fe34f315fd82136f8f68c0 x
+  s 69a1b67522704ec122181c0890bd16e9d3e7516a z
+  $ printf 45 > .hg/prefetchqueue.progress
+  $ hg prefetch -r 1 y
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ test -e .hg/prefetchqueue.progress
+  [1]
+  $ hg cat -r 1 x
+  x2
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+
+# a prefetch started while another one is running leaves its files for the
+# running one, which fetches everything queued in one go
+
+  $ clearcache
+  $ ln -s "`hostname`:$$" .hg/prefetch.lock
+  $ hg prefetch -r 1 y --background
+  $ sleep 1
+  $ cat .hg/prefetchqueue
+  s 076f5e2225b3ff0400b98c92aa6cdf403ee24cca y
+  $ rm .hg/prefetch.lock
+  $ hg prefetch -r 0 x
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ test -e .hg/prefetchqueue
+  [1]
+
+# a chunk with versions the server doesn't have is skipped
+
+  $ clearcache
+  $ echo "s 0000000000000000000000000000000000000001 x" > .hg/prefetchqueue
+  $ hg prefetch -r 1 y 2>&1 | grep -v fetched
+  warning: could not fetch queued files: x@0000000000000000000000000000000000000001: unable to download 1 files
+  $ test -e .hg/prefetchqueue
+  [1]
+
+# prefetch still works when .hg isn't writable
+
+  $ clearcache
+  $ chmod a-w .hg
+  $ hg prefetch -r 0
+  2 files fetched over 1 fetches - (2 misses, 0.00% hit ratio) over *s (glob)
+  $ chmod u+w .hg
+
+# an on demand fetch doesn't wait for a key leased by a running bulk prefetch
+
+  $ clearcache
+  $ mkdir -p $CACHEDIR/.fetches $CACHEDIR/master/11/f6ad8ec52a2984abaafd7c3b516503785c2072
+  $ ticket="1_`hostname`_$$_1"
+  $ touch $CACHEDIR/.fetches/$ticket
+  $ printf $ticket > $CACHEDIR/master/11/f6ad8ec52a2984abaafd7c3b516503785c2072/ef95c5376f34698742fe34f315fd82136f8f68c0.lease
+  $ hg cat -r 1 x
+  x2
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
+  $ rm $CACHEDIR/.fetches/$ticket
+
+# a lease left by a fetch that ended is ignored, even though its process is
+# still running
+
+  $ clearcache
+  $ mkdir -p $CACHEDIR/master/11/f6ad8ec52a2984abaafd7c3b516503785c2072
+  $ printf "0_`hostname`_$$_2" > $CACHEDIR/master/11/f6ad8ec52a2984abaafd7c3b516503785c2072/ef95c5376f34698742fe34f315fd82136f8f68c0.lease
+  $ hg cat -r 1 x
+  x2
+  1 files fetched over 1 fetches - (1 misses, 0.00% hit ratio) over *s (glob)
@@ -73,3 +73,9 @@
    .hgtags |  1 +
    1 files changed, 1 insertions(+), 0 deletions(-)
   
+
+# filelog patterns include files kept as normal filelogs
+
+  $ hg log -r 'filelog("glob:.hgt*")' -T '{rev}\n'
+  1
+  2